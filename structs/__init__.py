@@ -1,5 +1,10 @@
 from .constants import XP3Signature
-from .file import XP3File
-from .file_index import XP3FileIndex
+from .file import XP3File, XP3FileStream
+from .file_index import XP3FileIndex, XP3LazyEntries
+from .compact_index import XP3CompactEntries, XP3CompactPathIndex
+from .index_cache import XP3IndexCache
+from .content_cache import XP3ContentCache
+from .path_query import XP3PathQuery
 from .file_entry import XP3FileEntry, XP3FileEncryption, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo
 from .encryption_parameters import encryption_parameters
+from .source import XP3SeekSource, XP3MmapSource, XP3PreadSource, backends
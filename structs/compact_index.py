@@ -0,0 +1,184 @@
+import struct
+from array import array
+from bisect import bisect_right
+from collections.abc import Sequence, Mapping
+from .constants import XP3FileIsEncrypted
+from .file_entry import XP3FileEntry, XP3FileEncryption, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo
+
+
+class XP3CompactEntries(Sequence):
+    """
+    File entries of an index stored column by column in arrays, with all file paths in a single string,
+    entry objects are only created when accessed and are not kept around
+    """
+    _segment = struct.Struct('<?xxxQQQ')
+
+    # Column name and array type code
+    columns = (
+        ('adler32', 'I'),
+        ('timestamp', 'Q'),  # In milliseconds
+        ('is_encrypted', 'B'),
+        ('encryption', 'b'),  # Position in encryption_names, -1 if there is no encryption chunk
+        ('uncompressed_size', 'Q'),
+        ('compressed_size', 'Q'),
+        ('segment_start', 'Q'),  # Position of the first segment of an entry in segment columns, one extra at the end
+        ('path_offsets', 'Q'),  # File path and info file path boundaries in the string pool, two per entry
+        ('order', 'Q'),  # Entry positions sorted by file path
+        ('segment_is_compressed', 'B'),
+        ('segment_offset', 'Q'),
+        ('segment_uncompressed_size', 'Q'),
+        ('segment_compressed_size', 'Q'),
+    )
+
+    def __init__(self, columns: dict, paths: str, encryption_names: list):
+        """
+        :param columns: Arrays by column name
+        :param paths: String pool with all the file paths
+        :param encryption_names: Encryption chunk names
+        """
+        for name, _ in self.columns:
+            setattr(self, name, columns[name])
+        self.paths = paths
+        self.encryption_names = encryption_names
+        self.path_index = XP3CompactPathIndex(self)
+
+    @classmethod
+    def read_from(cls, index: bytes):
+        """Parse the raw file index straight into columns"""
+        columns = {name: array(typecode) for name, typecode in cls.columns}
+        paths = []
+        path_length = 0
+        encryption_names = []
+        segment_start = columns['segment_start']
+        segment_start.append(0)
+
+        for _, encryption_name, file_path, chunks in XP3FileEntry.scan(index):
+            encryption = -1
+            if encryption_name is not None:
+                if encryption_name not in encryption_names:
+                    encryption_names.append(encryption_name)
+                encryption = encryption_names.index(encryption_name)
+
+            timestamp = 0  # time chunk is not always present
+            adler32 = info = None
+            segments = 0
+            for name, chunk, chunk_size in chunks:
+                if name == b'time':
+                    timestamp, = struct.unpack_from('<Q', index, chunk)
+                elif name == b'adlr':
+                    adler32, = struct.unpack_from('<I', index, chunk)
+                elif name == b'segm':
+                    for segment in range(chunk_size // 28):
+                        is_compressed, offset, uncompressed_size, compressed_size = \
+                            cls._segment.unpack_from(index, chunk + segment * 28)
+                        columns['segment_is_compressed'].append(is_compressed)
+                        columns['segment_offset'].append(offset)
+                        columns['segment_uncompressed_size'].append(uncompressed_size)
+                        columns['segment_compressed_size'].append(compressed_size)
+                        segments += 1
+                elif name == b'info':
+                    info = XP3FileInfo.unpack_from(index, chunk)
+
+            if adler32 is None or not segments or info is None:
+                raise AssertionError
+            info_file_path = info[3]
+            if file_path is None:
+                file_path = info_file_path
+                info_file_path = ''  # Same as the file path
+
+            columns['adler32'].append(adler32)
+            columns['timestamp'].append(timestamp)
+            flags, uncompressed_size, compressed_size, _ = info
+            columns['is_encrypted'].append(bool(flags & XP3FileIsEncrypted))
+            columns['encryption'].append(encryption)
+            columns['uncompressed_size'].append(uncompressed_size)
+            columns['compressed_size'].append(compressed_size)
+            segment_start.append(segment_start[-1] + segments)
+            columns['path_offsets'].append(path_length)
+            path_length += len(file_path)
+            columns['path_offsets'].append(path_length)
+            path_length += len(info_file_path)
+            paths.append(file_path)
+            paths.append(info_file_path)
+        columns['path_offsets'].append(path_length)
+
+        paths = ''.join(paths)
+        entries = cls(columns, paths, encryption_names)
+        entries.order = array('Q', sorted(range(len(entries)), key=entries.file_path))
+        return entries
+
+    def file_path(self, item: int) -> str:
+        return self.paths[self.path_offsets[item * 2]:self.path_offsets[item * 2 + 1]]
+
+    @property
+    def file_paths(self) -> list:
+        return [self.file_path(item) for item in range(len(self))]
+
+    def __len__(self):
+        return len(self.adler32)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[index] for index in range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('Entry index out of range')
+
+        file_path = self.file_path(item)
+        info_file_path = self.paths[self.path_offsets[item * 2 + 1]:self.path_offsets[item * 2 + 2]] or file_path
+        adler32 = self.adler32[item]
+
+        encryption = self.encryption[item]
+        if encryption >= 0:
+            encryption = XP3FileEncryption(adler32, file_path, self.encryption_names[encryption])
+        else:
+            encryption = None
+
+        segments = [XP3FileSegments.segment(bool(self.segment_is_compressed[segment]),
+                                            self.segment_offset[segment],
+                                            self.segment_uncompressed_size[segment],
+                                            self.segment_compressed_size[segment])
+                    for segment in range(self.segment_start[item], self.segment_start[item + 1])]
+        segm = XP3FileSegments(segments)
+        info = XP3FileInfo(bool(self.is_encrypted[item]), self.uncompressed_size[item], self.compressed_size[item],
+                           info_file_path)
+
+        return XP3FileEntry(time=XP3FileTime.from_milliseconds(self.timestamp[item]), adlr=XP3FileAdler(adler32),
+                            segm=segm, info=info, encryption=encryption)
+
+
+class XP3CompactPathIndex(Mapping):
+    """File path to entry position lookup by binary search over the entries sorted by file path"""
+
+    def __init__(self, entries: XP3CompactEntries):
+        self.entries = entries
+
+    def __getitem__(self, file_path):
+        # Last of the matching entries wins, same as building a dict would
+        position = bisect_right(XP3SortedPaths(self.entries), file_path) - 1
+        if position >= 0:
+            item = self.entries.order[position]
+            if self.entries.file_path(item) == file_path:
+                return item
+        raise KeyError(file_path)
+
+    def __iter__(self):
+        for item in range(len(self.entries)):
+            yield self.entries.file_path(item)
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class XP3SortedPaths(Sequence):
+    """File paths of the entries in sorted order, for bisecting"""
+
+    def __init__(self, entries: XP3CompactEntries):
+        self.entries = entries
+
+    def __getitem__(self, position):
+        return self.entries.file_path(self.entries.order[position])
+
+    def __len__(self):
+        return len(self.entries.order)
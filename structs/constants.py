@@ -3,3 +3,4 @@ XP3FileIndexContinue = 0x80
 XP3FileIndexCompressed = 0x01
 Xp3FileIndexUncompressed = 0x00
 XP3FileIsEncrypted = 1 << 31
+XP3FileStreamChunkSize = 64 * 1024
@@ -0,0 +1,70 @@
+import threading
+from collections import OrderedDict
+
+
+class XP3ContentCache:
+    """
+    Least recently used cache of decoded file data, bounded by the total size of the data it holds.
+    Files up to pin_size bytes are pinned, they count towards the budget but are never evicted
+    """
+
+    def __init__(self, budget: int, pin_size: int = 0):
+        """
+        :param budget: Maximum number of bytes to hold
+        :param pin_size: Pin files of up to this many bytes, 0 to pin nothing
+        """
+        self.budget = budget
+        self.pin_size = pin_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # Key -> data, least recently used first
+        self._pinned = {}
+        self._pinned_size = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Cached data, or None if it's not cached"""
+        with self._lock:
+            data = self._pinned.get(key)
+            if data is None:
+                data = self._entries.get(key)
+                if data is not None:
+                    self._entries.move_to_end(key)
+            if data is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return data
+
+    def put(self, key, data) -> bytes:
+        """Cache the data if it fits in the budget, evicting the least recently used files, returns it as bytes"""
+        data = bytes(data)
+        with self._lock:
+            if key in self._pinned or key in self._entries:
+                return data
+            if len(data) > self.budget - self._pinned_size:
+                return data  # Wouldn't fit even with everything evictable gone, keep what is cached
+            while self._entries and self.size + len(data) > self.budget:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+            if self.size + len(data) <= self.budget:
+                if len(data) <= self.pin_size:
+                    self._pinned[key] = data
+                    self._pinned_size += len(data)
+                else:
+                    self._entries[key] = data
+                self.size += len(data)
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._pinned.clear()
+            self._pinned_size = 0
+            self.size = 0
+
+    def __len__(self):
+        return len(self._entries) + len(self._pinned)
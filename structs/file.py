@@ -1,11 +1,14 @@
 import os
-from io import BytesIO
-from array import array
+import io
 import zlib
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from .encryption_parameters import encryption_parameters
 from .file_entry import XP3FileEntry
+from .constants import XP3FileStreamChunkSize
+from .source import XP3SeekSource
 try:
-    from numpy import frombuffer, uint8, bitwise_and, bitwise_xor, right_shift, concatenate
+    from numpy import frombuffer, uint8, bitwise_xor
     numpy = True
 except ModuleNotFoundError:
     numpy = False
@@ -17,8 +20,10 @@ class XP3DecryptionError(Exception):
 
 class XP3File(XP3FileEntry):
     """Wrapper around file entry with buffer access to be able to read the file"""
+    parallel_segments = 4  # Decompress files with at least this many compressed segments in parallel
+    segment_jobs = os.cpu_count() or 1  # Number of workers to decompress segments with
 
-    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy):
+    def __init__(self, index_entry: XP3FileEntry, buffer, silent, use_numpy, source=None):
         super(XP3File, self).__init__(
             encryption=index_entry.encryption,
             time=index_entry.time,
@@ -27,35 +32,174 @@ class XP3File(XP3FileEntry):
             info=index_entry.info
         )
         self.buffer = buffer
+        self.source = source if source else XP3SeekSource(buffer)
         self.silent = silent
         self.use_numpy = use_numpy
+        self.cache = None  # Decoded data cache of the archive, keyed by cache_key and the encryption type
+        self.cache_key = None
 
-    def read(self, encryption_type='none', raw=False):
-        """Reads the file from buffer and return it's data"""
-        for segment in self.segm:
-            self.buffer.seek(segment.offset)
-            data = self.buffer.read(segment.compressed_size)
+    def read(self, encryption_type='none', raw=False, offset: int = 0, length: int = None):
+        """
+        Reads the file from buffer and return it's data,
+        with a memory mapped archive stored and unencrypted files are returned as a memoryview without copying,
+        encrypted files are decrypted in place and returned as a bytearray.
+        Files with several segments are decoded into a preallocated bytearray, in parallel if there are many of them.
+        If the archive caches decoded files, whole files are returned from the cache as bytes
+        :param offset: Position in the file to read from, a range is read with read_range
+        :param length: Number of bytes to read, up to the end of the file if not specified
+        """
+        if offset or length is not None:
+            size = self.segm.uncompressed_size
+            return self.read_range(offset, size if length is None else length, encryption_type, raw)
+        if self.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
 
-            if segment.is_compressed:
-                data = zlib.decompress(data)
-            if len(data) != segment.uncompressed_size:
-                raise AssertionError(len(data), segment.uncompressed_size)
+        if self.cache is not None:
+            key = self._cache_key(encryption_type)
+            data = self.cache.get(key)
+            if data is None:
+                data = self.cache.put(key, self._read(encryption_type))
+            return data
+        return self._read(encryption_type)
+
+    def _cache_key(self, encryption_type):
+        return self.cache_key, encryption_type if self.is_encrypted else None
+
+    def decode(self, segments: list, encryption_type='none', raw=False):
+        """
+        Decode the file from the data of its segments as stored in the archive, for callers that read them themselves
+        :param segments: Data of every segment, in order
+        """
+        if self.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
 
+        if len(segments) == 1:
+            # Copy stored data, the caller's read buffer might hold a lot more than this file
+            data = self._decode_segment(self.segm.segments[0], segments[0])
+            data = bytearray(data) if self.is_encrypted else bytes(data)
+        else:
+            data = bytearray(self.segm.uncompressed_size)
+            position = 0
+            for segment, segment_data in zip(self.segm, segments):
+                data[position:position + segment.uncompressed_size] = self._decode_segment(segment, segment_data)
+                position += segment.uncompressed_size
+
+        if self.is_encrypted:
+            self.xor_inplace(data, self.adler32, encryption_type, self.use_numpy)
+        if self.cache is not None:
+            data = self.cache.put(self._cache_key(encryption_type), data)
+        return data
+
+    def _read(self, encryption_type):
+        if len(self.segm.segments) == 1:
+            data = self._read_segment(self.segm.segments[0])
             if self.is_encrypted:
-                file_buffer = BytesIO(data)
-                if encryption_type in ('none', None) and not raw:
-                    raise XP3DecryptionError('File is encrypted and no encryption type was specified')
-                self.xor(file_buffer, self.adler32, encryption_type, self.use_numpy)
-                data = file_buffer.getvalue()
-                file_buffer.close()
+                data = bytearray(data)
+        else:
+            data = bytearray(self.segm.uncompressed_size)
+            with memoryview(data) as view:
+                def decode(segment, position, compressed_data):
+                    decoded = self._decode_segment(segment, compressed_data)
+                    view[position:position + len(decoded)] = decoded
+
+                # Reading the archive stays sequential, decompressing is what gets spread over the workers
+                segments = []
+                position = 0
+                for segment in self.segm:
+                    segments.append((segment, position, self.source.read(segment.offset, segment.compressed_size)))
+                    position += segment.uncompressed_size
+                compressed = sum(segment.is_compressed for segment in self.segm)
+                if compressed >= self.parallel_segments and self.segment_jobs > 1:
+                    for _ in segment_pool(self.segment_jobs).map(lambda arguments: decode(*arguments), segments):
+                        pass
+                else:
+                    for arguments in segments:
+                        decode(*arguments)
+
+        if self.is_encrypted:
+            self.xor_inplace(data, self.adler32, encryption_type, self.use_numpy)
+        return data
+
+    def read_range(self, start: int, length: int, encryption_type='none', raw=False) -> bytearray:
+        """
+        Read a byte range of the file without decoding the rest of it, stored segments are read at the right position
+        and compressed ones are only inflated as far as the range goes, then only the range is decrypted
+        :param start: Position in the file to read from
+        :param length: Number of bytes to read, less are returned if the range goes past the end of the file
+        """
+        if self.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+
+        start = min(max(start, 0), self.segm.uncompressed_size)
+        end = min(start + max(length, 0), self.segm.uncompressed_size)
+        data = bytearray(end - start)
+        position = 0
+        for segment in self.segm:
+            if position >= end:
+                break
+            segment_end = position + segment.uncompressed_size
+            if segment_end > start:
+                skip = max(start - position, 0)
+                size = min(end, segment_end) - position - skip
+                if segment.is_compressed:
+                    chunk = self._inflate(segment, skip, size)
+                else:
+                    chunk = self.source.read(segment.offset + skip, size)
+                if len(chunk) != size:
+                    raise AssertionError(len(chunk), size)
+                data[position + skip - start:position + skip - start + size] = chunk
+            position = segment_end
+
+        if self.is_encrypted:
+            self.xor_inplace(data, self.adler32, encryption_type, self.use_numpy, start)
+        return data
+
+    def _inflate(self, segment, skip: int, size: int) -> bytearray:
+        """Decompress part of a compressed segment, reading and inflating no further into it than needed"""
+        decompressor = zlib.decompressobj()
+        output = bytearray()
+        produced = read = 0
+        while produced < skip + size:
+            if decompressor.unconsumed_tail:
+                data = decompressor.unconsumed_tail
+            elif read < segment.compressed_size:
+                data = self.source.read(segment.offset + read,
+                                        min(XP3FileStreamChunkSize, segment.compressed_size - read))
+                if not data:
+                    raise AssertionError('Unexpected end of archive')
+                read += len(data)
+            else:
+                break
+
+            # Decompress no more than is still needed, the part before the range is thrown away as it comes
+            data = decompressor.decompress(data, skip + size - produced)
+            if produced + len(data) > skip:
+                output += data[max(skip - produced, 0):]
+            produced += len(data)
+        return output
+
+    def _read_segment(self, segment):
+        return self._decode_segment(segment, self.source.read(segment.offset, segment.compressed_size))
+
+    @staticmethod
+    def _decode_segment(segment, data):
+        """Decompress a segment read from the archive and check its size"""
+        if segment.is_compressed:
+            data = zlib.decompress(data, bufsize=segment.uncompressed_size or zlib.DEF_BUF_SIZE)
+        if len(data) != segment.uncompressed_size:
+            raise AssertionError(len(data), segment.uncompressed_size)
         return data
 
-    def extract(self, to='', name=None, encryption_type='none', raw=False):
+    def extract(self, to='', name=None, encryption_type='none', raw=False, makedirs: bool = True):
         """
         Reads the data and saves the file to specified folder,
         if no location is specified, unpacks into folder with archive name (data.xp3, unpacks into data folder)
+        :param makedirs: Create the folder the file goes in, if the caller hasn't created it already
         """
-        file = self.read(encryption_type=encryption_type, raw=raw)
+        self.save(self.read(encryption_type=encryption_type, raw=raw), to, name, makedirs)
+
+    def save(self, file, to='', name=None, makedirs: bool = True):
+        """Save the already read data of the file to specified folder, same as extract does"""
         if zlib.adler32(file) != self.adler32 and not self.silent:
             print('! Checksum error')
 
@@ -66,62 +210,210 @@ class XP3File(XP3FileEntry):
         if not name:
             name = self.file_path
         to = os.path.join(to, name)
-        dirname = os.path.dirname(to)
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
+        if makedirs:
+            dirname = os.path.dirname(to)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname, exist_ok=True)  # Another worker might have created it in the meantime
 
         with open(to, 'wb') as output:
             output.write(file)
 
+    def open_stream(self, encryption_type='none', raw=False, chunk_size: int = XP3FileStreamChunkSize):
+        """Open the file as a read-only file-like object, decompressing and decrypting it chunk by chunk"""
+        return XP3FileStream(self, encryption_type, raw, chunk_size)
+
+    def iter_chunks(self, encryption_type='none', raw=False, chunk_size: int = XP3FileStreamChunkSize):
+        """Yield the file data in chunks of at most chunk_size bytes"""
+        with self.open_stream(encryption_type, raw, chunk_size) as stream:
+            while True:
+                chunk = stream.read(chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+
     @staticmethod
-    def xor(output_buffer, adler32: int, encryption_type: str, use_numpy: bool = True):
-        """XOR the data, uses numpy if available"""
-        master_key, secondary_key, xor_the_first_byte, _ = encryption_parameters[encryption_type]
-        # Read the encrypted data from buffer
+    def xor(output_buffer, adler32: int, encryption_type: str, use_numpy: bool = True, offset: int = 0):
+        """
+        XOR the data in a buffer object
+        :param offset: Position of the data in the file, the first byte key only applies at the start of the file
+        """
+        output_buffer.seek(0)
+        data = bytearray(output_buffer.read())
+        XP3File.xor_inplace(data, adler32, encryption_type, use_numpy, offset)
         output_buffer.seek(0)
-        data = output_buffer.read()
+        output_buffer.write(data)
+
+    @staticmethod
+    def xor_inplace(data, adler32: int, encryption_type: str, use_numpy: bool = True, offset: int = 0):
+        """
+        XOR a writable buffer (bytearray, writable memoryview) in place, uses numpy if available
+        :param offset: Position of the data in the file, the first byte key only applies at the start of the file
+        """
+        xor_key, first_byte_key, table = xor_keys(adler32, encryption_type)
+        if offset:
+            first_byte_key = None
 
-        # Use numpy if available
         if numpy and use_numpy:
-            # Calculate the XOR key
-            adler_key = bitwise_xor(adler32, master_key)
-            xor_key = bitwise_and(bitwise_xor(bitwise_xor(bitwise_xor(right_shift(adler_key, 24), right_shift(adler_key, 16)), right_shift(adler_key, 8)), adler_key), 0xFF)
-            if not xor_key:
-                xor_key = secondary_key
-
-            data = frombuffer(data, dtype=uint8)
-
-            if xor_the_first_byte:
-                first_byte_key = bitwise_and(adler_key, 0xFF)
-                if not first_byte_key:
-                    first_byte_key = bitwise_and(master_key, 0xFF)
-                # Split the first byte into separate array
-                first = frombuffer(data[:1], dtype=uint8)
-                rest = frombuffer(data[1:], dtype=uint8)
-                # XOR the first byte
-                first = bitwise_xor(first, first_byte_key)
-                # Concatenate the array back
-                data = concatenate((first, rest))
-
-            data = bitwise_xor(data, xor_key)
+            array = frombuffer(data, dtype=uint8)
+            bitwise_xor(array, xor_key, out=array)
         else:
-            adler_key = adler32 ^ master_key
-            xor_key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
-            if not xor_key:
-                xor_key = secondary_key
+            # Translate every byte through the XOR table, instead of going byte by byte
+            data[:] = (data if isinstance(data, bytearray) else bytes(data)).translate(table)
 
-            data = array('B', data)
+        if first_byte_key is not None and len(data):
+            data[0] ^= first_byte_key
 
-            if xor_the_first_byte:
-                first_byte_key = adler_key & 0xFF
-                if not first_byte_key:
-                    first_byte_key = master_key & 0xFF
-                data[0] ^= first_byte_key
 
-            # XOR the data
-            for index in range(len(data)):
-                data[index] ^= xor_key
+@lru_cache(maxsize=4096)
+def xor_keys(adler32: int, encryption_type: str) -> (int, int, bytes):
+    """
+    Derive the keys to XOR a file with
+    :return XOR key, first byte key (None if the encryption doesn't XOR the first byte)
+            and a translation table that XORs every byte with the key
+    """
+    master_key, secondary_key, xor_the_first_byte, _ = encryption_parameters[encryption_type]
+    adler_key = adler32 ^ master_key
+    xor_key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF
+    if not xor_key:
+        xor_key = secondary_key
 
-        # Overwrite the buffer with decrypted/encrypted data
-        output_buffer.seek(0)
-        output_buffer.write(data.tobytes())
+    first_byte_key = None
+    if xor_the_first_byte:
+        first_byte_key = adler_key & 0xFF
+        if not first_byte_key:
+            first_byte_key = master_key & 0xFF
+
+    return xor_key, first_byte_key, xor_table(xor_key)
+
+
+@lru_cache(maxsize=None)
+def segment_pool(jobs: int) -> ThreadPoolExecutor:
+    """Worker pool shared by all files to decompress segments with, zlib releases the GIL while it works"""
+    return ThreadPoolExecutor(jobs)
+
+
+@lru_cache(maxsize=256)
+def xor_table(xor_key: int) -> bytes:
+    return bytes(byte ^ xor_key for byte in range(256))
+
+
+class XP3FileStream(io.RawIOBase):
+    """
+    Read-only file-like view of a file in the archive,
+    segments are read, decompressed and decrypted chunk by chunk so memory use stays bounded
+    """
+
+    def __init__(self, file: XP3File, encryption_type='none', raw=False, chunk_size: int = XP3FileStreamChunkSize):
+        if file.is_encrypted and encryption_type in ('none', None) and not raw:
+            raise XP3DecryptionError('File is encrypted and no encryption type was specified')
+        super().__init__()
+        self.file = file
+        self.encryption_type = encryption_type
+        self.chunk_size = chunk_size
+        self.size = file.segm.uncompressed_size
+        self._rewind()
+
+    def _rewind(self):
+        self._position = 0
+        self._produced = 0  # Bytes decoded so far
+        self._segment = 0  # Index of the segment being read
+        self._segment_read = 0  # Bytes read from the archive for the current segment
+        self._segment_produced = 0  # Bytes produced from the current segment
+        self._decompressor = None
+        self._chunk = b''
+        self._chunk_offset = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def _next_chunk(self) -> bytes:
+        """Read and decode the next chunk of data, returns empty bytes once all segments are done"""
+        segments = self.file.segm.segments
+        while self._segment < len(segments):
+            segment = segments[self._segment]
+            remaining = segment.compressed_size - self._segment_read
+            finished = False
+
+            if segment.is_compressed:
+                if not self._decompressor:
+                    self._decompressor = zlib.decompressobj()
+                if self._decompressor.unconsumed_tail:
+                    data = self._decompressor.decompress(self._decompressor.unconsumed_tail, self.chunk_size)
+                elif remaining:
+                    data = self._decompressor.decompress(self._read_raw(segment, remaining), self.chunk_size)
+                else:
+                    data = self._decompressor.flush()
+                    finished = True
+            elif remaining:
+                data = self._read_raw(segment, remaining)
+            else:
+                data = b''
+                finished = True
+
+            offset = self._produced
+            self._segment_produced += len(data)
+            self._produced += len(data)
+            if finished:
+                if self._segment_produced != segment.uncompressed_size:
+                    raise AssertionError(self._segment_produced, segment.uncompressed_size)
+                self._segment += 1
+                self._segment_read = self._segment_produced = 0
+                self._decompressor = None
+            if data:
+                return self._decrypt(data, offset)
+        return b''
+
+    def _read_raw(self, segment, remaining) -> bytes:
+        data = self.file.source.read(segment.offset + self._segment_read, min(self.chunk_size, remaining))
+        if not data:
+            raise AssertionError('Unexpected end of archive')
+        self._segment_read += len(data)
+        return data
+
+    def _decrypt(self, data, offset) -> bytes:
+        if not self.file.is_encrypted:
+            return data
+        data = bytearray(data)
+        XP3File.xor_inplace(data, self.file.adler32, self.encryption_type, self.file.use_numpy, offset)
+        return data
+
+    def readinto(self, b) -> int:
+        """Fill the buffer as far as possible, only returns less at the end of the file"""
+        with memoryview(b) as buffer, buffer.cast('B') as view:
+            filled = 0
+            while filled < len(view):
+                if self._chunk_offset >= len(self._chunk):
+                    self._chunk = self._next_chunk()
+                    self._chunk_offset = 0
+                    if not self._chunk:
+                        break
+
+                size = min(len(view) - filled, len(self._chunk) - self._chunk_offset)
+                view[filled:filled + size] = self._chunk[self._chunk_offset:self._chunk_offset + size]
+                self._chunk_offset += size
+                filled += size
+            self._position += filled
+            return filled
+
+    def seek(self, offset, whence=io.SEEK_SET) -> int:
+        """Seek by decoding up to the target position, seeking backwards starts over from the beginning"""
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+
+        if offset < self._position:
+            self._rewind()
+        with memoryview(bytearray(min(self.chunk_size, offset - self._position))) as skip:
+            while self._position < offset:
+                if not self.readinto(skip[:offset - self._position]):
+                    break
+        return self._position
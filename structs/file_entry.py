@@ -7,6 +7,7 @@ from .constants import XP3FileIsEncrypted
 
 
 class XP3FileEncryption:
+    __slots__ = ('name', 'adler32', 'file_path')
     encryption_chunk = struct.Struct('<QIH')
 
     def __init__(self, adler32: int, file_path: str, name: bytes = b'eliF'):
@@ -43,24 +44,33 @@ class XP3FileEncryption:
 
 
 class XP3FileTime:
+    __slots__ = ('timestamp', 'milliseconds')
     time_chunk = struct.Struct('<QQ')
 
     def __init__(self, timestamp: int = 0):
         self.timestamp = timestamp
+        self.milliseconds = timestamp  # Value written into the archive
 
+    @classmethod
+    def from_milliseconds(cls, milliseconds: int):
+        """Timestamp as read from an archive, in seconds, while keeping the original value to write back"""
+        time = cls(milliseconds // 1000)
+        time.milliseconds = milliseconds
+        return time
 
     @classmethod
     def read_from(cls, buffer: BufferedReader):
         size, timestamp = cls.time_chunk.unpack(buffer.read(16))
         if size != 8:
             raise AssertionError
-        return cls(timestamp // 1000)
+        return cls.from_milliseconds(timestamp)
 
     def to_bytes(self):
-        return b'time' + self.time_chunk.pack(8, self.timestamp)
+        return b'time' + self.time_chunk.pack(8, self.milliseconds)
 
 
 class XP3FileSegments:
+    __slots__ = ('segments',)
     segment = namedtuple('Segment', 'is_compressed, offset, uncompressed_size, compressed_size')
     _header = struct.Struct('<Q')
     _segment = struct.Struct('<?xxxQQQ')
@@ -102,8 +112,14 @@ class XP3FileSegments:
             .format(len(self.segments))
 
 
+# Let pickle find the segment type, so entries can be sent to worker processes
+XP3FileSegments.segment.__qualname__ = 'XP3FileSegments.segment'
+
+
 class XP3FileInfo:
+    __slots__ = ('is_encrypted', 'uncompressed_size', 'compressed_size', 'file_path')
     info_chunk = struct.Struct('<QIQQH')
+    info_data = struct.Struct('<IQQH')
 
     def __init__(self, is_encrypted: bool, uncompressed_size: int, compressed_size: int, file_path: str):
         self.is_encrypted = is_encrypted
@@ -128,6 +144,13 @@ class XP3FileInfo:
                                                                           start + size))
         return cls(encrypted, uncompressed_size, compressed_size, file_path)
 
+    @classmethod
+    def unpack_from(cls, index, offset: int) -> (int, int, int, str):
+        """Flags, sizes and file path of an info chunk in a raw file index, offset is where its data starts"""
+        flags, uncompressed_size, compressed_size, file_path_length = cls.info_data.unpack_from(index, offset)
+        offset += cls.info_data.size
+        return flags, uncompressed_size, compressed_size, str(index[offset:offset + file_path_length * 2], 'utf-16le')
+
     def to_bytes(self):
         size = 4 + 8 + 8 + 2 + (len(self.file_path) * 2) + 2
         flags = XP3FileIsEncrypted if self.is_encrypted else 0
@@ -142,6 +165,7 @@ class XP3FileInfo:
 
 
 class XP3FileAdler:
+    __slots__ = ('value',)
     adler32_chunk = struct.Struct('<QI')
 
     def __init__(self, adler32: int):
@@ -166,7 +190,9 @@ class XP3FileAdler:
 
 
 class XP3FileEntry:
+    __slots__ = ('encryption', 'time', 'adlr', 'segm', 'info')
     file_chunk = struct.Struct('<Q')
+    chunk_header = struct.Struct('<4sQ')
 
     def __init__(self, time: XP3FileTime, adlr: XP3FileAdler, segm: XP3FileSegments, info: XP3FileInfo,
                  encryption: XP3FileEncryption = None):
@@ -214,6 +240,38 @@ class XP3FileEntry:
 
         return cls(adlr=adlr, segm=segm, info=info, time=time, encryption=encryption)
 
+    @classmethod
+    def scan(cls, index):
+        """
+        Walk the entries of a raw file index without building them, for every entry yields where it starts,
+        the name of its encryption chunk and the file path held there (None if there is none)
+        and the name, data offset and size of each chunk in its File chunk, as they are iterated over
+        """
+        position = 0
+        while position < len(index):
+            start = position
+            name, size = cls.chunk_header.unpack_from(index, position)
+            encryption = file_path = None
+            if name != b'File':  # Encryption chunk, holds the actual file path
+                encryption = name
+                file_path_length, = struct.unpack_from('<H', index, position + 16)
+                file_path = str(index[position + 18:position + 18 + file_path_length * 2], 'utf-16le')
+                position += 12 + size
+                name, size = cls.chunk_header.unpack_from(index, position)
+                if name != b'File':
+                    raise AssertionError
+
+            position += 12 + size
+            yield start, encryption, file_path, cls._chunks(index, position - size, position)
+
+    @classmethod
+    def _chunks(cls, index, chunk: int, end: int):
+        while chunk < end:
+            name, size = cls.chunk_header.unpack_from(index, chunk)
+            chunk += 12
+            yield name, chunk, size
+            chunk += size
+
     @property
     def adler32(self):
         return self.adlr.value
@@ -1,7 +1,13 @@
 import os
 import zlib
 import struct
-from .file_entry import XP3FileEntry
+import threading
+from array import array
+from collections.abc import Sequence
+from .file_entry import XP3FileEntry, XP3FileInfo
+from .compact_index import XP3CompactEntries
+from .index_cache import XP3IndexCache
+from .path_query import XP3PathQuery
 from io import BytesIO
 from .constants import XP3Signature, XP3FileIndexContinue, XP3FileIndexCompressed, Xp3FileIndexUncompressed
 
@@ -29,20 +35,80 @@ class peek:
         self.input_buffer.seek(self.initial_position)
 
 
+class XP3LazyEntries(Sequence):
+    """
+    File entries of an index that are only parsed once accessed,
+    a single scan over the index records where every entry starts and its file path
+    """
+    def __init__(self, index: bytes):
+        self.index = index
+        self.offsets = array('Q')
+        self.file_paths = []
+        self._scan()
+        self._entries = [None] * len(self.offsets)
+        self._buffer = BytesIO(index)
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        for offset, _, file_path, chunks in XP3FileEntry.scan(self.index):
+            self.offsets.append(offset)
+            if file_path is None:
+                file_path = next((XP3FileInfo.unpack_from(self.index, chunk)[3]
+                                  for name, chunk, _ in chunks if name == b'info'), None)
+                if file_path is None:
+                    raise AssertionError
+            self.file_paths.append(file_path)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return [self[index] for index in range(*item.indices(len(self)))]
+
+        entry = self._entries[item]
+        if entry is None:
+            with self._lock:
+                self._buffer.seek(self.offsets[item])
+                entry = self._entries[item] = XP3FileEntry.read_from(self._buffer)
+        return entry
+
+
 class XP3FileIndex:
     def __init__(self, entries: list, buffer=None):
         self.entries = entries
-        self.path_index = {entry.file_path: index for index, entry in enumerate(entries)}
+        self.path_index = getattr(entries, 'path_index', None)
+        if self.path_index is None:
+            file_paths = getattr(entries, 'file_paths', None) or (entry.file_path for entry in entries)
+            self.path_index = {file_path: index for index, file_path in enumerate(file_paths)}
         self.buffer = buffer
+        self._paths = None
+
+    @property
+    def paths(self) -> XP3PathQuery:
+        """Listing, prefix, case-insensitive and glob queries over the file paths, built on first use"""
+        if self._paths is None:
+            file_paths = getattr(self.entries, 'file_paths', None) or [entry.file_path for entry in self.entries]
+            self._paths = XP3PathQuery(file_paths)
+        return self._paths
 
     @classmethod
     def from_entries(cls, entries: list, buffer=None):
         return cls(entries, buffer)
 
     @classmethod
-    def read_from(cls, buffer):
-        """Constructor to instantiate class from buffer"""
-        index = cls.read_index(buffer)
+    def read_from(cls, buffer, view: memoryview = None, mode: str = 'eager'):
+        """
+        Constructor to instantiate class from buffer, or from a memoryview of the whole archive if one is given
+        :param mode: 'eager' to parse every entry, 'lazy' to only scan the index for file paths and parse entries
+                     when accessed, 'compact' to parse the index into arrays and create entries when accessed
+        """
+        index = cls.read_index(buffer) if view is None else cls.read_index_view(view)
+        if mode == 'lazy':
+            return cls.from_entries(XP3LazyEntries(index), buffer)
+        elif mode == 'compact':
+            return cls.from_entries(XP3CompactEntries.read_from(index), buffer)
+
         entries = []
         with BytesIO(index) as index_buffer:
             while index_buffer.tell() < len(index):
@@ -50,6 +116,21 @@ class XP3FileIndex:
 
         return cls.from_entries(entries, buffer)
 
+    @classmethod
+    def read_cached(cls, buffer, cache_path: str, view: memoryview = None):
+        """
+        Constructor using the compact index cached in a sidecar file,
+        the cache is (re)built from the archive if it's missing or stale
+        """
+        cache = XP3IndexCache(cache_path)
+        key = cache.key(buffer)
+        entries = cache.load(key)
+        if entries is None:
+            index = cls.read_index(buffer) if view is None else cls.read_index_view(view)
+            entries = XP3CompactEntries.read_from(index)
+            cache.save(key, entries)
+        return cls.from_entries(entries, buffer)
+
     def extract(self, to=''):
         """Dump file index from buffer"""
 
@@ -65,6 +146,30 @@ class XP3FileIndex:
 
         return self
 
+    @staticmethod
+    def regions(buffer) -> list:
+        """Where the file index of the archive in the buffer is stored, as (start, end) ranges, redirect included"""
+        buffer.seek(len(XP3Signature))
+        offset, = struct.unpack('<Q', buffer.read(8))
+        regions = []
+        buffer.seek(offset)
+        flag, = struct.unpack('<B', buffer.read(1))
+        if flag == XP3FileIndexContinue:
+            regions.append((offset, offset + 17))
+            offset, = struct.unpack('<8xQ', buffer.read(16))
+            buffer.seek(offset)
+            flag, = struct.unpack('<B', buffer.read(1))
+
+        if flag == XP3FileIndexCompressed:
+            compressed_size, _ = struct.unpack('<2Q', buffer.read(16))
+            regions.append((offset, offset + 17 + compressed_size))
+        elif flag == Xp3FileIndexUncompressed:
+            uncompressed_size, = struct.unpack('<Q', buffer.read(8))
+            regions.append((offset, offset + 9 + uncompressed_size))
+        else:
+            raise AssertionError('Unexpected index flag {}'.format(flag))
+        return regions
+
     @staticmethod
     def read_index(buffer):
         """Reads file index from buffer"""
@@ -93,6 +198,31 @@ class XP3FileIndex:
 
         return index
 
+    @staticmethod
+    def read_index_view(view: memoryview):
+        """Reads file index from a memoryview of the whole archive, without going through a file object"""
+        offset, = struct.unpack_from('<Q', view, len(XP3Signature))
+        if not offset:
+            raise AssertionError('File index offset is missing')
+
+        flag, = struct.unpack_from('<B', view, offset)
+        if flag == XP3FileIndexContinue:  # Index is in another castle
+            offset, = struct.unpack_from('<8xQ', view, offset + 1)
+            flag, = struct.unpack_from('<B', view, offset)
+
+        if flag == XP3FileIndexCompressed:
+            compressed_size, uncompressed_size = struct.unpack_from('<2Q', view, offset + 1)
+            index = zlib.decompress(view[offset + 17:offset + 17 + compressed_size])
+            if len(index) != uncompressed_size:
+                raise AssertionError('Index size mismatch')
+        elif flag == Xp3FileIndexUncompressed:
+            uncompressed_size, = struct.unpack_from('<Q', view, offset + 1)
+            index = view[offset + 9:offset + 9 + uncompressed_size]
+        else:
+            raise AssertionError('Unexpected index flag {}'.format(flag))
+
+        return index
+
     def to_bytes(self):
         uncompressed_index = b''.join([entry.to_bytes() for entry in self.entries])
         compressed_index = zlib.compress(uncompressed_index, level=9)
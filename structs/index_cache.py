@@ -0,0 +1,114 @@
+import os
+import sys
+import mmap
+import zlib
+import struct
+from array import array
+from .constants import XP3Signature, XP3FileIndexContinue
+from .compact_index import XP3CompactEntries
+
+
+class XP3IndexCache:
+    """
+    Sidecar file holding the compact file index of an archive, the columns are stored as they are in memory,
+    so loading it is a memory map without parsing anything.
+    The cache is keyed by the archive size, modification time and the position and header of the file index,
+    if any of them changes the cache is considered stale.
+    """
+    magic = b'XP3IDX\x00\x03'
+    # Magic, archive size, mtime (ns), index offset, index header CRC, byte order,
+    # padded to a multiple of 8 bytes so the columns after it are aligned
+    _header = struct.Struct('<8sQQQIB11x')
+    _column = struct.Struct('<QB7x')  # Length in bytes, item size
+
+    def __init__(self, path: str):
+        """:param path: Path to the cache file"""
+        self.path = path
+
+    @staticmethod
+    def key(buffer) -> tuple:
+        """Identify the archive state the index belongs to, the buffer position is left untouched"""
+        position = buffer.tell()
+        try:
+            stat = os.fstat(buffer.fileno())
+            buffer.seek(len(XP3Signature))
+            offset, = struct.unpack('<Q', buffer.read(8))
+            buffer.seek(offset)
+            index_header = buffer.read(17)
+            if index_header[:1] == bytes((XP3FileIndexContinue,)):  # Index is in another castle
+                offset, = struct.unpack_from('<8xQ', index_header, 1)
+                buffer.seek(offset)
+                index_header = buffer.read(17)
+        finally:
+            buffer.seek(position)
+        return stat.st_size, stat.st_mtime_ns, offset, zlib.crc32(index_header), sys.byteorder == 'big'
+
+    def load(self, key: tuple):
+        """Map the cached index, returns None if there is no cache or it's stale"""
+        try:
+            with open(self.path, 'rb') as file:
+                cache = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):  # Missing or empty
+            return None
+
+        view = memoryview(cache)
+        columns = {}
+        try:
+            loaded = self._read_columns(view, key, columns)
+        except (struct.error, TypeError, ValueError):  # Truncated or otherwise broken
+            loaded = None
+        if loaded is None:
+            for column in columns.values():
+                column.release()
+            view.release()
+            cache.close()
+            return None
+
+        entries = XP3CompactEntries(columns, *loaded)
+        entries.cache = cache  # Keep the mapping around as long as the entries
+        return entries
+
+    def _read_columns(self, view: memoryview, key: tuple, columns: dict):
+        """Cast the columns of the cache into the dictionary, returns the paths and encryption names or None if stale"""
+        magic, *cached_key = self._header.unpack_from(view)
+        if magic != self.magic or tuple(cached_key) != key:
+            return None
+
+        position = self._header.size
+        for name, typecode in XP3CompactEntries.columns:
+            size, itemsize = self._column.unpack_from(view, position)
+            position += self._column.size
+            if itemsize != array(typecode).itemsize:
+                return None
+            columns[name] = view[position:position + size].cast(typecode)
+            position += -size % 8 + size
+
+        count, = struct.unpack_from('<Q', view, position)
+        position += 8
+        encryption_names = [bytes(view[position + index * 4:position + index * 4 + 4]) for index in range(count)]
+        position += count * 4
+        size, = struct.unpack_from('<Q', view, position)
+        paths = str(view[position + 8:position + 8 + size], 'utf-8', 'surrogatepass')
+        return paths, encryption_names
+
+    def save(self, key: tuple, entries: XP3CompactEntries):
+        """Write the cache next to the archive, silently gives up if the location is not writable"""
+        temporary_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        try:
+            with open(temporary_path, 'wb') as file:
+                file.write(self._header.pack(self.magic, *key))
+                for name, typecode in XP3CompactEntries.columns:
+                    column = memoryview(getattr(entries, name)).cast('B')
+                    file.write(self._column.pack(len(column), array(typecode).itemsize))
+                    file.write(column)
+                    file.write(bytes(-len(column) % 8))  # Keep the columns aligned
+
+                file.write(struct.pack('<Q', len(entries.encryption_names)))
+                file.write(b''.join(entries.encryption_names))
+                paths = entries.paths.encode('utf-8', 'surrogatepass')
+                file.write(struct.pack('<Q', len(paths)))
+                file.write(paths)
+            os.replace(temporary_path, self.path)  # Readers never see a half-written cache
+        except OSError:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
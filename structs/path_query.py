@@ -0,0 +1,95 @@
+import re
+import fnmatch
+from array import array
+from bisect import bisect_left, bisect_right
+
+_last = '\U0010ffff'  # Sorts after any other character, ends the range of paths starting with a prefix
+_wildcards = re.compile(r'[*?\[\]]')
+
+
+class XP3PathQuery:
+    """
+    Case-insensitive queries over the file paths of an index (the engine doesn't care about case either),
+    by binary search over the lowercase paths in sorted order,
+    patterns that only fix the end of the path (like *.ks) search the reversed paths instead
+    """
+
+    def __init__(self, file_paths):
+        """:param file_paths: File paths in index order"""
+        self.file_paths = file_paths
+        lowered = [file_path.lower() for file_path in file_paths]
+        order = sorted(range(len(lowered)), key=lowered.__getitem__)
+        self._paths = [lowered[position] for position in order]
+        self._order = array('Q', order)
+        self._reversed = None  # Reversed paths and their order, built on first use
+        self._reversed_order = None
+
+    def _range(self, prefix: str) -> (int, int):
+        return bisect_left(self._paths, prefix), bisect_right(self._paths, prefix + _last)
+
+    def find(self, file_path: str) -> int:
+        """Position of the file in the index, ignoring case, the last one wins if several match"""
+        file_path = file_path.lower()
+        start, end = bisect_left(self._paths, file_path), bisect_right(self._paths, file_path)
+        if start == end:
+            raise KeyError(file_path)
+        return max(self._order[start:end])
+
+    def prefix(self, prefix: str) -> list:
+        """Positions of the files with paths starting with the prefix, in path order"""
+        start, end = self._range(prefix.lower())
+        return list(self._order[start:end])
+
+    def listdir(self, directory: str = '') -> list:
+        """Names of the files and folders in a folder, in path order"""
+        prefix = directory.lower().strip('/')
+        prefix = prefix + '/' if prefix else ''
+        position, end = self._range(prefix)
+        if position == end and prefix:
+            raise FileNotFoundError(directory)
+
+        names = []
+        while position < end:
+            path = self._paths[position]
+            file_path = self.file_paths[self._order[position]]
+            if len(file_path) != len(path):  # Lowercasing changed the length, the original can't be sliced alike
+                file_path = path
+            slash = path.find('/', len(prefix))
+            if slash < 0:
+                names.append(file_path[len(prefix):])
+                position += 1
+            else:
+                names.append(file_path[len(prefix):slash])
+                position = bisect_right(self._paths, path[:slash + 1] + _last, position, end)  # Skip the subfolder
+        return names
+
+    def glob(self, pattern: str) -> list:
+        """
+        Positions of the files matching a shell-style pattern, in path order,
+        only the paths starting or ending with the fixed part of the pattern are checked
+        """
+        pattern = pattern.lower()
+        wildcards = [match.start() for match in _wildcards.finditer(pattern)]
+        if not wildcards:
+            try:
+                return [self.find(pattern)]
+            except KeyError:
+                return []
+
+        prefix = pattern[:wildcards[0]]
+        suffix = pattern[wildcards[-1] + 1:]
+        start, end = self._range(prefix)
+        match = re.compile(fnmatch.translate(pattern)).match
+        if len(suffix) > len(prefix):
+            if self._reversed is None:
+                reversed_paths = [path[::-1] for path in self._paths]
+                order = sorted(range(len(reversed_paths)), key=reversed_paths.__getitem__)
+                self._reversed = [reversed_paths[position] for position in order]
+                self._reversed_order = array('Q', order)
+            suffix = suffix[::-1]
+            suffix_start = bisect_left(self._reversed, suffix)
+            suffix_end = bisect_right(self._reversed, suffix + _last)
+            if suffix_end - suffix_start < end - start:
+                sorted_positions = sorted(self._reversed_order[suffix_start:suffix_end])
+                return [self._order[position] for position in sorted_positions if match(self._paths[position])]
+        return [self._order[position] for position in range(start, end) if match(self._paths[position])]
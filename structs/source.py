@@ -0,0 +1,108 @@
+import os
+import mmap
+import threading
+from io import BytesIO
+
+
+class XP3SeekSource:
+    """Reads data with seek and read on the archive buffer, the buffer position is shared so it's not thread-safe"""
+    thread_safe = False
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+
+    def read(self, offset: int, size: int):
+        self.buffer.seek(offset)
+        return self.buffer.read(size)
+
+    def close(self):
+        pass
+
+
+class XP3MmapSource:
+    """
+    Reads data from a memory map of the archive, returns memoryview slices without copying,
+    there is no shared position so it's safe to read from many threads at once
+    """
+    thread_safe = True
+
+    def __init__(self, buffer):
+        if isinstance(buffer, BytesIO):
+            # A view of the buffer's bytes rather than an export of the buffer, which couldn't be closed
+            # while slices of it are still in use
+            self._mmap = None
+            self.view = memoryview(buffer.getvalue())
+        else:
+            self._mmap = mmap.mmap(buffer.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self._mmap)
+
+    def read(self, offset: int, size: int):
+        if offset + size > len(self.view):
+            raise AssertionError('Reading past the end of the archive')
+        return self.view[offset:offset + size]
+
+    def close(self):
+        self.view.release()
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError:  # Slices are still in use, the mapping goes away with the last one of them
+                pass
+
+
+class XP3PreadSource:
+    """
+    Reads data with positional reads (os.pread) that don't touch the buffer position, safe to use from many threads,
+    where os.pread is not available every thread gets a file handle of its own
+    """
+    thread_safe = True
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self._handles = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        if isinstance(buffer, BytesIO):
+            self.view = buffer.getbuffer()
+            self.read = self._read_view
+        elif hasattr(os, 'pread'):
+            self.fileno = buffer.fileno()
+            self.read = self._pread
+        else:
+            self.read = self._read_handle
+
+    def _read_view(self, offset: int, size: int) -> bytes:
+        return bytes(self.view[offset:offset + size])
+
+    def _pread(self, offset: int, size: int) -> bytes:
+        data = os.pread(self.fileno, size, offset)
+        while len(data) < size:  # Short reads are allowed, keep going until the end of the file
+            chunk = os.pread(self.fileno, size - len(data), offset + len(data))
+            if not chunk:
+                break
+            data += chunk
+        return data
+
+    def _read_handle(self, offset: int, size: int) -> bytes:
+        handle = getattr(self._local, 'handle', None)
+        if not handle:
+            handle = self._local.handle = open(self.buffer.name, 'rb')
+            with self._lock:
+                self._handles.append(handle)
+        handle.seek(offset)
+        return handle.read(size)
+
+    def close(self):
+        if isinstance(self.buffer, BytesIO):
+            self.view.release()
+        with self._lock:
+            for handle in self._handles:
+                handle.close()
+            self._handles.clear()
+
+
+backends = {
+    'seek': XP3SeekSource,
+    'mmap': XP3MmapSource,
+    'pread': XP3PreadSource
+}
@@ -1,8 +1,24 @@
 import os
+import sys
+import time
+import asyncio
+import mmap
+import fnmatch
+import contextlib
 import unittest
 import datetime
 import tempfile
-from xp3 import XP3, XP3Reader, XP3Writer
+import subprocess
+import tracemalloc
+import io
+from io import BytesIO
+from unittest import mock
+from concurrent.futures import ThreadPoolExecutor
+from xp3 import XP3, XP3Reader, XP3Writer, XP3CompressionPolicy
+from xp3vfs import XP3VirtualFS
+from xp3async import AsyncXP3Reader
+from structs import XP3File, XP3ContentCache, XP3FileIndex, XP3IndexCache, XP3CompactEntries, encryption_parameters
+from structs.file import XP3DecryptionError, segment_pool
 
 
 class Encryption(unittest.TestCase):
@@ -113,5 +129,995 @@ class DuplicateWrite(unittest.TestCase):
                 xp3.add('duplicate_file', b'12345', None)
 
 
+class XorFallback(unittest.TestCase):
+    """Numpy and pure Python XORing should match the byte by byte reference"""
+
+    @staticmethod
+    def reference(data, adler32, encryption_type):
+        master_key, secondary_key, xor_the_first_byte, _ = encryption_parameters[encryption_type]
+        adler_key = adler32 ^ master_key
+        xor_key = (adler_key >> 24 ^ adler_key >> 16 ^ adler_key >> 8 ^ adler_key) & 0xFF or secondary_key
+        data = bytearray(data)
+        if xor_the_first_byte and data:
+            data[0] ^= adler_key & 0xFF or master_key & 0xFF
+        return bytes(byte ^ xor_key for byte in data)
+
+    @staticmethod
+    def xor(data, adler32, encryption_type, use_numpy):
+        with BytesIO(data) as buffer:
+            XP3File.xor(buffer, adler32, encryption_type, use_numpy)
+            return buffer.getvalue()
+
+    def test(self):
+        data = os.urandom(1000)
+        for encryption_type in encryption_parameters:
+            for adler32 in (0, 0x1548E29C, 0x12345678, 0xFFFFFFFF):
+                expected = self.reference(data, adler32, encryption_type)
+                self.assertEqual(expected, self.xor(data, adler32, encryption_type, False))
+                self.assertEqual(expected, self.xor(data, adler32, encryption_type, True))
+                for use_numpy in (False, True):
+                    buffer = bytearray(data)
+                    XP3File.xor_inplace(memoryview(buffer)[:500], adler32, encryption_type, use_numpy)
+                    XP3File.xor_inplace(memoryview(buffer)[500:], adler32, encryption_type, use_numpy, offset=500)
+                    self.assertEqual(expected, buffer)
+
+
+@unittest.skipUnless(os.environ.get('XP3_BENCHMARK'), 'Set XP3_BENCHMARK=1 to run the benchmarks')
+class XorBenchmark(unittest.TestCase):
+    """XOR throughput of the pure Python fallback against Numpy"""
+
+    def test(self):
+        data = os.urandom(64 * 1024 * 1024)
+        for use_numpy in (False, True):
+            start = time.perf_counter()
+            XorFallback.xor(data, 0x12345678, 'neko_vol0', use_numpy)
+            elapsed = time.perf_counter() - start
+            print('\n{}: {:.0f} MB/s'.format('Numpy' if use_numpy else 'Python', len(data) / elapsed / 1e6), end='')
+
+
+class ParallelExtract(unittest.TestCase):
+    """Parallel extraction should produce the same files as serial extraction"""
+
+    dummy_data = [('folder{}/dummyfile{}'.format(index % 3, index), os.urandom(index * 97) + b'1' * index)
+                  for index in range(40)]
+
+    def extract(self, xp3dir, out, backend='seek', **kwargs):
+        with XP3(os.path.join(xp3dir, 'data.xp3'), mode='r', silent=True, backend=backend) as xp3:
+            xp3.extract(os.path.join(xp3dir, out), **kwargs)
+
+        files = {}
+        for dirpath, dirs, filenames in os.walk(os.path.join(xp3dir, out)):
+            for filename in filenames:
+                with open(os.path.join(dirpath, filename), 'rb') as file:
+                    files[os.path.relpath(os.path.join(dirpath, filename), os.path.join(xp3dir, out))] = file.read()
+        return files
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            with XP3(os.path.join(xp3dir, 'data.xp3'), mode='w', silent=True) as xp3:
+                for filepath, data in self.dummy_data:
+                    xp3.add(filepath, data, 'neko_vol0')
+
+            serial = self.extract(xp3dir, 'serial', encryption_type='neko_vol0')
+            self.assertEqual(len(self.dummy_data), len(serial))
+            self.assertEqual(serial, self.extract(xp3dir, 'threads', encryption_type='neko_vol0', jobs=4))
+            self.assertEqual(serial, self.extract(xp3dir, 'processes', encryption_type='neko_vol0', jobs=2,
+                                                  use_processes=True))
+            self.assertEqual(serial, self.extract(xp3dir, 'mmap', 'mmap', encryption_type='neko_vol0', jobs=4))
+
+
+class ParallelPack(unittest.TestCase):
+    """Packing with workers should produce the same archive as packing serially"""
+
+    dummy_data = [('dummyfile{}'.format(index), os.urandom(index * 31) + b'1' * index * 50) for index in range(40)]
+
+    def pack(self, **kwargs):
+        with XP3Writer(silent=True, **kwargs) as xp3:
+            for index, (filepath, data) in enumerate(self.dummy_data):
+                xp3.add(filepath, data, 'neko_vol1' if index % 2 else None, timestamp=index * 1000)
+            return xp3.pack_up()
+
+    def test(self):
+        serial = self.pack()
+        self.assertEqual(serial, self.pack(jobs=4))
+        self.assertEqual(serial, self.pack(jobs=3, max_in_flight=1024))  # Writer has to block on the workers
+
+
+class StreamRead(unittest.TestCase):
+    """Reading a file through a stream should match reading it whole"""
+
+    data = os.urandom(5000) + b'1' * 20000 + os.urandom(3000)
+
+    def check(self, encryption_type):
+        with XP3Writer(silent=True, use_numpy=False) as xp3:
+            xp3.add('dummy_file', self.data, encryption_type)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True, use_numpy=False) as xp3:
+            file = xp3.open('dummy_file')
+            self.assertEqual(self.data, b''.join(file.iter_chunks(encryption_type, chunk_size=1000)))
+            with file.open_stream(encryption_type, chunk_size=1000) as stream:
+                self.assertEqual(self.data[:10], stream.read(10))
+                buffer = bytearray(2500)
+                self.assertEqual(len(buffer), stream.readinto(buffer))
+                self.assertEqual(self.data[10:2510], buffer)
+                self.assertEqual(7000, stream.seek(7000))
+                self.assertEqual(self.data[7000:27000], stream.read(20000))
+                stream.seek(0)  # Seeking backwards starts over
+                self.assertEqual(self.data[:5], stream.read(5))
+                stream.seek(-10, os.SEEK_END)
+                self.assertEqual(self.data[-10:], stream.read())
+                self.assertEqual(b'', stream.read(1))
+
+    def test_plain(self):
+        self.check(None)
+
+    def test_encrypted(self):
+        self.check('neko_vol0')
+
+
+class StreamWrite(unittest.TestCase):
+    """Streaming file objects and chunks into the archive should produce the same archive as adding bytes"""
+
+    dummy_data = (
+        ('compressed', b'1' * 20000 + os.urandom(100)),
+        ('uncompressed', os.urandom(20000)),
+        ('empty', b'')
+    )
+
+    def pack(self, to_input, encryption_type):
+        with XP3Writer(silent=True, use_numpy=False) as xp3:
+            xp3.stream_chunk_size = 1000
+            for filepath, data in self.dummy_data:
+                xp3.add(filepath, to_input(data), encryption_type)
+            return xp3.pack_up()
+
+    def check(self, encryption_type):
+        archive = self.pack(bytes, encryption_type)
+        chunks = lambda data: (data[index:index + 777] for index in range(0, len(data), 777))
+        self.assertEqual(archive, self.pack(BytesIO, encryption_type))
+        self.assertEqual(archive, self.pack(chunks, encryption_type))
+
+        with XP3Reader(archive, silent=True, use_numpy=False) as xp3:
+            for filepath, data in self.dummy_data:
+                self.assertEqual(data, xp3.open(filepath).read(encryption_type))
+
+    def test_plain(self):
+        self.check(None)
+
+    def test_encrypted(self):
+        self.check('neko_vol0')
+
+
+class MmapRead(unittest.TestCase):
+    """Memory mapped archives should read the same as seek and read"""
+
+    dummy_data = (
+        ('stored', os.urandom(1000), None),
+        ('compressed', b'1' * 5000, None),
+        ('encrypted', b'1' * 5000 + os.urandom(100), 'neko_vol1')
+    )
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3Writer(open(xp3_path, 'wb'), silent=True, use_numpy=False) as xp3:
+                for filepath, data, encryption_type in self.dummy_data:
+                    xp3.add(filepath, data, encryption_type)
+
+            with XP3(xp3_path, 'r', silent=True, backend='mmap') as xp3:
+                xp3.use_numpy = False
+                for filepath, data, encryption_type in self.dummy_data:
+                    self.assertEqual(data, xp3.open(filepath).read(encryption_type or 'none'))
+                    self.assertEqual(data, b''.join(xp3.open(filepath).iter_chunks(encryption_type or 'none')))
+                stored = xp3.open('stored').read()
+                self.assertIsInstance(stored, memoryview)  # Not copied out of the mapping
+                stored.release()
+
+            with open(xp3_path, 'rb') as buffer, XP3Reader(buffer.read(), silent=True, backend='mmap') as xp3:
+                self.assertEqual(self.dummy_data[1][1], xp3.open('compressed').read())
+
+    def test_in_memory(self):
+        """Slices of an in-memory archive still in use shouldn't keep it from closing"""
+        with XP3Writer(silent=True) as xp3:
+            for filepath, data, encryption_type in self.dummy_data:
+                xp3.add(filepath, data, encryption_type)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True, backend='mmap') as xp3:
+            stored = xp3.open('stored').read()
+        self.assertEqual(self.dummy_data[0][1], stored)
+
+
+class ConcurrentRead(unittest.TestCase):
+    """Reading a single archive from many threads at once"""
+
+    dummy_data = [('dummyfile{}'.format(index), os.urandom(index * 100) + b'1' * 5000) for index in range(30)]
+
+    def read_all(self, xp3):
+        return [xp3.open(filepath).read() for filepath, _ in self.dummy_data]
+
+    def check(self, backend):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(xp3_path, 'w', silent=True) as xp3:
+                for filepath, data in self.dummy_data:
+                    xp3.add(filepath, data)
+
+            expected = [data for _, data in self.dummy_data]
+            with XP3(xp3_path, 'r', silent=True, backend=backend) as xp3, ThreadPoolExecutor(8) as executor:
+                for result in executor.map(self.read_all, [xp3] * 32):
+                    self.assertEqual(expected, result)
+
+    def test_pread(self):
+        self.check('pread')
+
+    def test_mmap(self):
+        self.check('mmap')
+
+
+@unittest.skipUnless(os.environ.get('XP3_BENCHMARK'), 'Set XP3_BENCHMARK=1 to run the benchmarks')
+class ConcurrentReadBenchmark(unittest.TestCase):
+    """Read throughput of a single open archive by thread count"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(xp3_path, 'w', silent=True, jobs=os.cpu_count()) as xp3:
+                for index in range(256):
+                    xp3.add('dummyfile{}'.format(index), os.urandom(1024) * 1024)  # Compressible, reads have to inflate
+            size = 256 * 1024 * 1024
+
+            for backend in ('pread', 'mmap'):
+                with XP3(xp3_path, 'r', silent=True, backend=backend) as xp3:
+                    for threads in (1, 2, 4, 8):
+                        with ThreadPoolExecutor(threads) as executor:
+                            start = time.perf_counter()
+                            for _ in executor.map(lambda index: xp3.open(index).read(), range(256)):
+                                pass
+                            elapsed = time.perf_counter() - start
+                        print('\n{} backend, {} thread(s): {:.0f} MB/s'.format(backend, threads, size / elapsed / 1e6),
+                              end='')
+
+
+class LazyIndex(unittest.TestCase):
+    """Lazily parsed and compact file indexes should match the eagerly parsed one"""
+
+    def check(self, index_mode):
+        with XP3Writer(silent=True) as xp3:
+            for index in range(20):
+                xp3.add('folder/dummyfile{}'.format(index), b'dummydata' * index, 'neko_vol0' if index % 2 else None,
+                        timestamp=index * 1000)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as eager, XP3Reader(archive, silent=True, index_mode=index_mode) as lazy:
+            self.assertEqual(dict(eager.file_index.path_index), dict(lazy.file_index.path_index))
+            self.assertEqual(b'dummydata' * 7, lazy.open('folder/dummyfile7').read('neko_vol0'))
+            self.assertEqual(b'dummydata' * 8, lazy.open('folder/dummyfile8').read())
+            self.assertNotIn('folder/dummyfile20', lazy.file_index.path_index)
+            self.assertEqual(20, len(lazy.file_index.entries))
+            self.assertEqual(eager.file_index.to_bytes(), lazy.file_index.to_bytes())
+            for eager_entry, lazy_entry in zip(eager.file_index, lazy.file_index):
+                self.assertEqual(eager_entry.to_bytes(), lazy_entry.to_bytes())
+
+    def test_lazy(self):
+        self.check('lazy')
+
+    def test_compact(self):
+        self.check('compact')
+
+
+class IndexCache(unittest.TestCase):
+    """Sidecar index cache should be used when fresh and rebuilt when stale"""
+
+    def pack(self, xp3_path, count):
+        with XP3(xp3_path, 'w', silent=True) as xp3:
+            for index in range(count):
+                xp3.add('folder/dummyfile{}'.format(index), b'dummydata' * index, 'neko_vol1' if index % 2 else None)
+
+    def check(self, xp3_path, count, cached):
+        with XP3(xp3_path, 'r', silent=True, index_cache=True) as xp3, XP3(xp3_path, 'r', silent=True) as eager:
+            self.assertEqual(cached, hasattr(xp3.file_index.entries, 'cache'))
+            self.assertEqual(count, len(xp3.file_index.entries))
+            self.assertEqual(eager.file_index.to_bytes(), xp3.file_index.to_bytes())
+            self.assertEqual(b'dummydata' * 3, xp3.open('folder/dummyfile3').read('neko_vol1'))
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            self.pack(xp3_path, 10)
+            self.check(xp3_path, 10, cached=False)
+            self.assertTrue(os.path.isfile(xp3_path + '.idx'))
+            self.check(xp3_path, 10, cached=True)
+
+            self.pack(xp3_path, 12)  # Archive changed, cache is stale
+            self.check(xp3_path, 12, cached=False)
+            self.check(xp3_path, 12, cached=True)
+
+            with open(xp3_path + '.idx', 'r+b') as cache:  # Broken cache
+                cache.truncate(100)
+            self.check(xp3_path, 12, cached=False)
+
+    def test_layout(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            self.pack(xp3_path, 10)
+            self.check(xp3_path, 10, cached=False)
+            with open(xp3_path + '.idx', 'rb') as cache:
+                data = cache.read()
+
+            position = XP3IndexCache._header.size
+            for _ in XP3CompactEntries.columns:  # Columns are 8-byte aligned in the file
+                size, _ = XP3IndexCache._column.unpack_from(data, position)
+                position += XP3IndexCache._column.size
+                self.assertEqual(0, position % 8)
+                position += -size % 8 + size
+
+            # Stale and broken caches don't leave their mapping open
+            mappings = []
+            original = mmap.mmap
+            with mock.patch('structs.index_cache.mmap.mmap', side_effect=lambda *args, **kwargs: mappings.append(
+                    original(*args, **kwargs)) or mappings[-1]):
+                cache = XP3IndexCache(xp3_path + '.idx')
+                self.assertIsNone(cache.load((0, 0, 0, 0, False)))
+                with open(xp3_path + '.idx', 'r+b') as file:
+                    file.truncate(100)
+                with open(xp3_path, 'rb') as buffer:
+                    self.assertIsNone(cache.load(XP3IndexCache.key(buffer)))
+            self.assertEqual(2, len(mappings))
+            self.assertTrue(all(mapping.closed for mapping in mappings))
+
+
+class AppendWrite(unittest.TestCase):
+    """Updating an archive in place should keep the existing data and replace updated files"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(xp3_path, 'w', silent=True) as xp3:
+                for index in range(10):
+                    xp3.add('dummyfile{}'.format(index), os.urandom(1000), timestamp=1234567)
+            with XP3(xp3_path, 'r', silent=True) as xp3:
+                original = {file.file_path: (file.read(), file.segm[0].offset) for file in xp3}
+
+            with XP3(xp3_path, 'a', silent=True) as xp3:
+                xp3.add('dummyfile3', b'replaced', 'neko_vol1')
+                xp3.add('newfile', b'1' * 5000)
+
+            with XP3(xp3_path, 'r', silent=True) as xp3:
+                self.assertEqual(11, len(xp3.file_index.entries))
+                self.assertEqual(b'replaced', xp3.open('dummyfile3').read('neko_vol1'))
+                self.assertEqual(b'1' * 5000, xp3.open('newfile').read())
+                for filepath, (data, offset) in original.items():
+                    if filepath != 'dummyfile3':
+                        file = xp3.open(filepath)
+                        self.assertEqual(data, file.read())
+                        self.assertEqual(offset, file.segm[0].offset)  # Existing data is kept in place
+                        self.assertEqual(1234, file.time.timestamp)
+                        self.assertEqual(1234567, file.time.milliseconds)
+
+    def test_interrupted(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(xp3_path, 'w', silent=True) as xp3:
+                for index in range(10):
+                    xp3.add('dummyfile{}'.format(index), os.urandom(1000))
+            with open(xp3_path, 'rb') as buffer:
+                (old_index_start, old_index_end), = XP3FileIndex.regions(buffer)
+
+            # Update that never gets to write its file index, the archive still has to read as before
+            xp3 = XP3(xp3_path, 'a', silent=True)
+            xp3.add('dummyfile3', os.urandom(5000))
+            xp3.add('newfile', os.urandom(5000))
+            xp3.buffer.close()
+            with XP3(xp3_path, 'r', silent=True) as xp3:
+                self.assertEqual(10, len(xp3.file_index.entries))
+                self.assertEqual(1000, len(xp3.open('dummyfile3').read()))
+
+            with XP3(xp3_path, 'a', silent=True) as xp3:
+                xp3.add('newfile', b'1' * 5000)
+            size = os.path.getsize(xp3_path)
+
+            # The file index of the previous update is reused for new data
+            data = os.urandom(old_index_end - old_index_start)
+            with XP3(xp3_path, 'a', silent=True) as xp3:
+                xp3.add('reclaimed', data)
+            with XP3(xp3_path, 'r', silent=True) as xp3:
+                file = xp3.open('reclaimed')
+                self.assertEqual(old_index_start, file.segm[0].offset)
+                self.assertEqual(data, file.read())
+                self.assertEqual(b'1' * 5000, xp3.open('newfile').read())
+                self.assertEqual(12, len(xp3.file_index.entries))
+            with open(xp3_path, 'rb') as buffer:
+                (index_start, index_end), = XP3FileIndex.regions(buffer)
+            self.assertEqual(size, index_start)  # Only the new file index went after the previous one
+            self.assertEqual(index_end, os.path.getsize(xp3_path))
+
+
+class RawCopy(unittest.TestCase):
+    """Copying files between archives without recompressing them"""
+
+    dummy_data = (
+        ('stored', os.urandom(3000), None),
+        ('compressed', b'1' * 5000, None),
+        ('encrypted', b'1' * 5000 + os.urandom(100), 'neko_vol0')
+    )
+
+    def check(self, source, target):
+        for filepath, data, encryption_type in self.dummy_data:
+            copy = target.open(filepath)
+            original = source.open(filepath)
+            self.assertEqual(data, copy.read(encryption_type or 'none'))
+            self.assertEqual(original.segm[0].compressed_size, copy.segm[0].compressed_size)
+            self.assertEqual(original.time.milliseconds, copy.time.milliseconds)
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            xp3_path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(xp3_path, 'w', silent=True) as xp3:
+                for filepath, data, encryption_type in self.dummy_data:
+                    xp3.add(filepath, data, encryption_type, timestamp=1234567)
+                xp3.add('removed', b'removed')
+
+            with XP3(xp3_path, 'r', silent=True) as source:
+                with XP3(os.path.join(xp3dir, 'copy.xp3'), 'w', silent=True) as target:
+                    target.add('first', b'first')  # Make sure offsets are rewritten
+                    for file in source:
+                        if file.file_path != 'removed':
+                            target.add_raw_entry(file)
+                with XP3Writer(silent=True) as target:  # No file descriptor, copied through reads
+                    for file in source:
+                        target.add_raw_entry(file)
+                    archive = target.pack_up()
+
+                with XP3(os.path.join(xp3dir, 'copy.xp3'), 'r', silent=True) as target:
+                    self.assertNotIn('removed', target.file_index.path_index)
+                    self.check(source, target)
+                with XP3Reader(archive, silent=True) as target:
+                    self.check(source, target)
+
+    def test_pipeline(self):
+        """Raw copies between compressed files should keep their order without restarting the workers"""
+        with XP3Writer(silent=True) as xp3:
+            for index in range(10):
+                xp3.add('raw{}'.format(index), self.dummy_data[index % 3][1], self.dummy_data[index % 3][2])
+            source = xp3.pack_up()
+
+        archives = []
+        with XP3Reader(source, silent=True) as source:
+            for jobs in (1, 4):
+                with mock.patch('xp3writer.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as pools, \
+                        XP3Writer(silent=True, jobs=jobs) as xp3:
+                    for index in range(10):
+                        xp3.add('file{}'.format(index), str(index).encode() * 1000 * index)
+                        xp3.add_raw_entry(source.open(index), timestamp=index)
+                    xp3.add('streamed', BytesIO(b'streamed' * 1000))
+                    xp3.add('last', b'last' * 1000)
+                    archives.append(xp3.pack_up())
+                self.assertEqual(1 if jobs > 1 else 0, pools.call_count)
+        self.assertEqual(archives[0], archives[1])
+
+
+class BaselineRepack(unittest.TestCase):
+    """Repacking against a previous build should copy unchanged files and produce the same contents"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as datadir, tempfile.TemporaryDirectory() as xp3dir:
+            os.makedirs(os.path.join(datadir, 'folder'))
+            for index in range(10):
+                with open(os.path.join(datadir, 'folder', 'dummyfile{}'.format(index)), 'wb') as file:
+                    file.write(b'dummydata' * index * 100)
+
+            baseline_path = os.path.join(xp3dir, 'baseline.xp3')
+            with XP3(baseline_path, 'w', silent=True) as xp3:
+                xp3.add_folder(datadir, encryption_type='neko_vol1')
+
+            with open(os.path.join(datadir, 'folder', 'dummyfile3'), 'wb') as file:  # Same size, changed
+                file.write(b'DUMMYDATA' * 300)
+            with open(os.path.join(datadir, 'newfile'), 'wb') as file:
+                file.write(b'newfile')
+
+            for verify in (False, True):
+                xp3_path = os.path.join(xp3dir, 'data.xp3')
+                with XP3(xp3_path, 'w', silent=True) as xp3:
+                    xp3.add_folder(datadir, encryption_type='neko_vol1', baseline=baseline_path,
+                                   verify_baseline=verify)
+                    self.assertEqual(9, xp3.baseline_reused)
+
+                with XP3(xp3_path, 'r', silent=True) as xp3:
+                    self.assertEqual(11, len(xp3.file_index.entries))
+                    self.assertEqual(b'DUMMYDATA' * 300, xp3.open('folder/dummyfile3').read('neko_vol1'))
+                    self.assertEqual(b'dummydata' * 500, xp3.open('folder/dummyfile5').read('neko_vol1'))
+                    self.assertEqual(b'newfile', xp3.open('newfile').read('neko_vol1'))
+
+            with XP3(xp3_path, 'w', silent=True) as xp3:  # Different encryption, nothing can be reused
+                xp3.add_folder(datadir, baseline=baseline_path)
+                self.assertEqual(0, xp3.baseline_reused)
+
+            # Same chunk name, different key
+            with XP3(xp3_path, 'w', silent=True) as xp3:
+                xp3.add_folder(datadir, encryption_type='neko_vol1_steam', baseline=baseline_path)
+                self.assertEqual(1, xp3.baseline_reused)  # Only the empty file, there is nothing to decrypt
+            with XP3(xp3_path, 'r', silent=True) as xp3:
+                self.assertEqual(b'dummydata' * 500, xp3.open('folder/dummyfile5').read('neko_vol1_steam'))
+
+    def test_jobs(self):
+        """Packing against a baseline with several jobs should give the same archive as with one"""
+        with tempfile.TemporaryDirectory() as datadir, tempfile.TemporaryDirectory() as xp3dir:
+            for index in range(40):
+                with open(os.path.join(datadir, 'dummyfile{}'.format(index)), 'wb') as file:
+                    file.write(b'dummydata' * index * 100)
+            baseline_path = os.path.join(xp3dir, 'baseline.xp3')
+            with XP3(baseline_path, 'w', silent=True) as xp3:
+                xp3.add_folder(datadir, encryption_type='neko_vol1')
+            for index in range(0, 40, 2):
+                with open(os.path.join(datadir, 'dummyfile{}'.format(index)), 'wb') as file:
+                    file.write(b'DUMMYDATA' * index * 100 + b'changed')
+
+            archives = []
+            for jobs in (1, 4):
+                xp3_path = os.path.join(xp3dir, 'data{}.xp3'.format(jobs))
+                with mock.patch('xp3writer.ThreadPoolExecutor', wraps=ThreadPoolExecutor) as pools, \
+                        XP3(xp3_path, 'w', silent=True, jobs=jobs) as xp3:
+                    xp3.add_folder(datadir, encryption_type='neko_vol1', baseline=baseline_path)
+                    self.assertEqual(20, xp3.baseline_reused)
+                self.assertEqual(1 if jobs > 1 else 0, pools.call_count)
+                with open(xp3_path, 'rb') as file:
+                    archives.append(file.read())
+            self.assertEqual(archives[0], archives[1])
+
+
+class Dedup(unittest.TestCase):
+    """Identical files should share their data, in every write path"""
+
+    def test(self):
+        for jobs, stream in ((1, False), (2, False), (1, True)):
+            with XP3Writer(silent=True, jobs=jobs, dedup=True) as xp3:
+                for index in range(3):
+                    data = b'dummydata' * 1000
+                    xp3.add('copy{}'.format(index), BytesIO(data) if stream else data, 'neko_vol1')
+                xp3.add('other', b'otherdata' * 1000, 'neko_vol1')
+                xp3.add('plain', b'dummydata' * 1000)  # Same data, different encryption
+                self.assertEqual(2, xp3.dedup_files)
+                self.assertEqual(2 * xp3.file_entries[0].segm.compressed_size, xp3.dedup_saved)
+                archive = xp3.pack_up()
+
+            with XP3Reader(archive, silent=True) as xp3:
+                offsets = {entry.file_path: entry.segm.segments[0].offset for entry in xp3.file_index}
+                self.assertEqual(offsets['copy0'], offsets['copy1'])
+                self.assertEqual(offsets['copy0'], offsets['copy2'])
+                self.assertEqual(3, len(set(offsets.values())))
+                for index in range(3):
+                    self.assertEqual(b'dummydata' * 1000, xp3.open('copy{}'.format(index)).read('neko_vol1'))
+                self.assertEqual(b'dummydata' * 1000, xp3.open('plain').read())
+
+    def test_failed_original(self):
+        """A file that failed to be written leaves nothing for the next identical file to point to"""
+        for jobs, stream in ((1, False), (2, False), (1, True)):
+            with XP3Writer(silent=True, jobs=jobs, dedup=True) as xp3:
+                for path in ('failed', 'failed_again'):
+                    with self.assertRaises(KeyError):
+                        data = b'dummydata' * 1000
+                        xp3.add(path, BytesIO(data) if stream else data, 'unknown')
+                        xp3.pack_up()
+                self.assertEqual(0, xp3.dedup_files)
+
+
+class CompressionPolicy(unittest.TestCase):
+    """Extension rules and the probe decide what gets compressed, the data reads back the same either way"""
+
+    def test(self):
+        noise = os.urandom(64 * 1024)
+        files = (('music.OGG', b'dummydata' * 1000, False),  # Stored by rule even though it would shrink
+                 ('image.png', b'dummydata' * 1000, True),
+                 ('noise.bin', noise, False),  # Stored by the probe
+                 ('text.txt', b'dummydata' * 1000, True))
+        for stream in (False, True):
+            compression = XP3CompressionPolicy(rules={'ogg': 'store', '.png': 'fast'}, probe_size=4096)
+            with XP3Writer(silent=True, compression=compression) as xp3:
+                for path, data, _ in files:
+                    xp3.add(path, BytesIO(data) if stream else data, 'neko_vol1')
+                archive = xp3.pack_up()
+            self.assertEqual({'store', 'fast', 'probed', 'default'}, set(compression.stats))
+            self.assertEqual(1, compression.stats['probed'][0])
+
+            with XP3Reader(archive, silent=True) as xp3:
+                for path, data, compressed in files:
+                    file = xp3.open(path)
+                    self.assertEqual(compressed, file.segm.segments[0].is_compressed)
+                    self.assertEqual(data, file.read('neko_vol1'))
+
+    def test_level(self):
+        with self.assertRaises(ValueError):
+            XP3CompressionPolicy(level=10)
+        with XP3Writer(silent=True, compression=XP3CompressionPolicy(level=0)) as xp3:
+            xp3.add('file', b'dummydata' * 1000)
+            self.assertFalse(xp3.file_entries[0].segm.segments[0].is_compressed)
+
+    def test_cli(self):
+        """Extension rules given before the positional arguments shouldn't swallow them"""
+        with tempfile.TemporaryDirectory() as folder:
+            source = os.path.join(folder, 'source')
+            os.makedirs(source)
+            for name in ('music.ogg', 'image.png', 'text.txt'):
+                with open(os.path.join(source, name), 'wb') as file:
+                    file.write(b'dummydata' * 1000)
+            output = os.path.join(folder, 'data.xp3')
+            subprocess.run([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'xp3.py'),
+                            '-m', 'r', '-s', '--store', '.ogg', '--store', '.png', source, output], check=True)
+
+            with XP3(output, 'r', silent=True) as xp3:
+                compressed = {file.file_path: file.segm.segments[0].is_compressed for file in xp3}
+        self.assertEqual({'music.ogg': False, 'image.png': False, 'text.txt': True}, compressed)
+
+
+class SegmentedWrite(unittest.TestCase):
+    """Big files should be split into independently compressed segments, in every write path"""
+
+    def test(self):
+        data = (b'dummydata' * 10000 + os.urandom(100000)) * 2  # Segments that compress and ones that don't
+        for jobs, stream in ((1, False), (3, False), (1, True), (3, True)):
+            with XP3Writer(silent=True, jobs=jobs, segment_size=32 * 1024) as xp3:
+                xp3.add('small', b'dummydata')
+                xp3.add('big', BytesIO(data) if stream else data, 'neko_vol1')
+                archive = xp3.pack_up()
+
+            with XP3Reader(archive, silent=True) as xp3:
+                self.assertEqual(1, len(xp3.open('small').segm.segments))
+                file = xp3.open('big')
+                segments = file.segm.segments
+                self.assertEqual(-(-len(data) // (32 * 1024)), len(segments))
+                self.assertTrue(all(segment.uncompressed_size == 32 * 1024 for segment in segments[:-1]))
+                self.assertEqual({True, False}, {segment.is_compressed for segment in segments})
+                self.assertEqual(len(data), file.info.uncompressed_size)
+                self.assertEqual(data, file.open_stream('neko_vol1').read())
+
+
+class SegmentedRead(unittest.TestCase):
+    """Files with several segments should read back whole, serially or in parallel, and by ranges"""
+
+    def test(self):
+        data = (b'dummydata' * 10000 + os.urandom(100000)) * 2
+        with XP3Writer(silent=True, segment_size=16 * 1024) as xp3:
+            xp3.add('big', data, 'neko_vol0')  # XORs the first byte too
+            xp3.add('plain', data)
+            xp3.add('empty', b'')
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True) as xp3:
+            for parallel_segments in (4, 1000):
+                file = xp3.open('big')
+                file.parallel_segments = parallel_segments
+                file.segment_jobs = 4
+                self.assertEqual(data, file.read('neko_vol0'))
+                self.assertEqual(data, xp3.open('plain').read())
+                for offset, length in ((0, 1), (1, 100), (16 * 1024 - 10, 20), (50000, 100000),
+                                       (len(data) - 5, 100), (len(data), 10), (100, 0), (300000, None)):
+                    self.assertEqual(data[offset:offset + length if length is not None else None],
+                                     file.read('neko_vol0', offset=offset, length=length))
+                self.assertEqual(file.read_range(100, 50000, 'neko_vol0'),
+                                 file.read('neko_vol0', offset=100, length=50000))
+            self.assertEqual(b'', bytes(xp3.open('empty').read()))
+
+
+class RangeRead(unittest.TestCase):
+    """Byte ranges should read the same as slicing the whole file, from stored and compressed segments"""
+
+    def test(self):
+        data = b'dummydata' * 10000 + os.urandom(100000) + b'dummydata' * 10000
+        ranges = ((0, 1), (1, 100), (16 * 1024 - 10, 20), (50000, 100000), (95000, 5000),
+                  (len(data) - 5, 100), (len(data), 10), (100, 0), (0, len(data)))
+        for segment_size in (0, 16 * 1024):
+            with XP3Writer(silent=True, segment_size=segment_size) as xp3:
+                xp3.add('big', data, 'neko_vol0')
+                xp3.add('plain', data)
+                archive = xp3.pack_up()
+
+            with XP3Reader(archive, silent=True) as xp3:
+                for start, length in ranges:
+                    self.assertEqual(data[start:start + length],
+                                     xp3.open('big').read_range(start, length, 'neko_vol0'))
+                    self.assertEqual(data[start:start + length], xp3.open('plain').read_range(start, length))
+
+
+class VirtualFS(unittest.TestCase):
+    """Later mounts should override earlier ones, with paths matched case-insensitively"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as folder:
+            archives = {'data.xp3': {'image/bg.png': b'data', 'scenario/first.ks': b'data', 'only/data.txt': b'data'},
+                        'patch.xp3': {'Image/BG.png': b'patch', 'scenario/first.ks': b'patch'},
+                        'patch2.xp3': {'scenario/first.ks': b'patch2'},
+                        'unrelated.xp3': {'scenario/first.ks': b'unrelated'}}
+            for name, files in archives.items():
+                with XP3(os.path.join(folder, name), 'w', silent=True) as xp3:
+                    for path, data in files.items():
+                        xp3.add(path, data, 'neko_vol1')
+            os.makedirs(os.path.join(folder, 'loose', 'image'))
+            with open(os.path.join(folder, 'loose', 'image', 'bg.png'), 'wb') as file:
+                file.write(b'loose')
+
+            with XP3VirtualFS(max_open=1).mount_patches(folder) as vfs:
+                self.assertEqual(3, len(vfs))
+                self.assertEqual(b'patch', vfs.read('image/bg.png', 'neko_vol1'))
+                self.assertEqual(b'patch2', vfs.read('SCENARIO\\first.ks', 'neko_vol1'))
+                with vfs.open('only/data.txt', 'neko_vol1') as file:
+                    self.assertEqual(b'patch2', vfs.read('scenario/first.ks', 'neko_vol1'))  # Evicts data.xp3
+                    self.assertEqual(b'data', file.read())
+                self.assertEqual(1, len(vfs._open))
+                self.assertEqual({}, vfs._leases)
+                self.assertNotIn('unrelated.xp3', vfs)
+                with self.assertRaises(KeyError):
+                    vfs.read('missing')
+
+                vfs.mount(os.path.join(folder, 'loose'))
+                self.assertEqual(b'loose', vfs.read('Image/Bg.png'))
+                self.assertEqual(os.path.join(folder, 'patch2.xp3'), vfs.resolve('scenario/first.ks')[0])
+
+    def test_threads(self):
+        """Archives evicted by one thread shouldn't be closed under the reads of another"""
+        with tempfile.TemporaryDirectory() as folder:
+            for name in ('first.xp3', 'second.xp3', 'third.xp3'):
+                with XP3(os.path.join(folder, name), 'w', silent=True) as xp3:
+                    for index in range(20):
+                        xp3.add('{}/{}'.format(name, index), os.urandom(64) * 1000 + name.encode())
+
+            with XP3VirtualFS(max_open=1) as vfs:
+                for name in ('first.xp3', 'second.xp3', 'third.xp3'):
+                    vfs.mount(os.path.join(folder, name))
+
+                def read(index):
+                    path = list(vfs)[index % len(vfs)]
+                    if index % 2:
+                        with vfs.open(path) as file:
+                            return path, file.read()
+                    return path, vfs.read(path)
+
+                with ThreadPoolExecutor(8) as executor:
+                    for path, data in executor.map(read, range(600)):
+                        self.assertEqual(path.split('/')[0].encode(), data[-len(path.split('/')[0]):])
+                self.assertEqual({}, vfs._leases)
+                self.assertLessEqual(len(vfs._open), 1)
+
+
+class ContentCache(unittest.TestCase):
+    """Repeat reads should come from the cache, which stays within its budget"""
+
+    def test(self):
+        with XP3Writer(silent=True) as xp3:
+            xp3.add('small', b'small', 'neko_vol1')
+            for index in range(5):
+                xp3.add('file{}'.format(index), str(index).encode() * 1000)
+            archive = xp3.pack_up()
+
+        with XP3Reader(archive, silent=True, cache_size=2500, pin_size=100) as xp3:
+            self.assertEqual(b'small', xp3.open('small').read('neko_vol1'))
+            self.assertEqual(b'small', xp3.open(0).read('neko_vol1'))
+            self.assertEqual((1, 1), (xp3.cache.hits, xp3.cache.misses))
+            with self.assertRaises(XP3DecryptionError):
+                xp3.open('small').read()
+
+            for index in range(5):
+                self.assertEqual(str(index).encode() * 1000, xp3.open('file{}'.format(index)).read())
+                self.assertLessEqual(xp3.cache.size, 2500)
+            self.assertEqual(3, xp3.cache.evictions)
+            self.assertEqual(b'4' * 1000, xp3.open('file4').read())
+            self.assertEqual(b'small', xp3.open('small').read('neko_vol1'))  # Pinned, never evicted
+            self.assertEqual((3, 6), (xp3.cache.hits, xp3.cache.misses))
+            self.assertEqual(b'0' * 100, xp3.open('file0').read(offset=100, length=100))  # Ranges skip the cache
+            self.assertEqual((3, 6), (xp3.cache.hits, xp3.cache.misses))
+
+    def test_too_big(self):
+        """Data that can't fit shouldn't evict anything"""
+        cache = XP3ContentCache(1000, pin_size=100)
+        cache.put('pinned', b'p' * 100)
+        for index in range(5):
+            cache.put(index, b'x' * 150)
+        cache.put('big', b'x' * 5000)
+        cache.put('almost', b'x' * 950)  # Fits the budget, but not next to the pinned data
+        self.assertEqual(6, len(cache))
+        self.assertEqual((0, 850), (cache.evictions, cache.size))
+        self.assertIsNone(cache.get('big'))
+
+
+class AsyncRead(unittest.TestCase):
+    """Async reads should match the data, with big files in chunks that don't hold up small ones"""
+
+    def test(self):
+        big = os.urandom(300000)
+        with tempfile.TemporaryDirectory() as xp3dir:
+            path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(path, 'w', silent=True) as xp3:
+                xp3.add('folder/big', big, 'neko_vol0')
+                for index in range(20):
+                    xp3.add('folder/small{}'.format(index), str(index).encode() * 100, 'neko_vol0')
+
+            async def run():
+                with XP3Reader(open(path, 'rb'), silent=True) as reader, self.assertRaises(ValueError):
+                    AsyncXP3Reader(reader)  # Seek and read is not thread-safe
+
+                async with await AsyncXP3Reader.open(path, jobs=2, chunk_size=16 * 1024, max_pending=4) as xp3:
+                    self.assertEqual((16 * 1024, 4), (xp3.chunk_size, xp3._slots._value))
+                    finished = []
+
+                    async def read(item):
+                        data = await xp3.read(item, 'neko_vol0')
+                        finished.append(item)
+                        return data
+
+                    results = await asyncio.gather(read('folder/big'),
+                                                   *(read('folder/small{}'.format(index)) for index in range(20)))
+                    self.assertEqual(big, results[0])
+                    self.assertEqual([str(index).encode() * 100 for index in range(20)], results[1:])
+                    self.assertEqual('folder/big', finished[-1])
+
+                    chunks = [chunk async for chunk in xp3.iter_chunks('folder/big', 'neko_vol0', 100000)]
+                    self.assertEqual([100000, 100000, 100000], [len(chunk) for chunk in chunks])
+
+                    await xp3.extract(os.path.join(xp3dir, 'out'), 'neko_vol0')
+                    with open(os.path.join(xp3dir, 'out', 'folder', 'big'), 'rb') as file:
+                        self.assertEqual(big, file.read())
+                    with open(os.path.join(xp3dir, 'out', 'folder', 'small7'), 'rb') as file:
+                        self.assertEqual(b'7' * 100, file.read())
+
+            asyncio.run(run())
+
+    def test_extract_failure(self):
+        """A file failing to extract should stop the others instead of leaving them running"""
+        with tempfile.TemporaryDirectory() as xp3dir:
+            path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(path, 'w', silent=True) as xp3:
+                xp3.add('blocked/file', b'blocked')
+                for index in range(50):
+                    xp3.add('folder/file{}'.format(index), str(index).encode() * 100)
+            out = os.path.join(xp3dir, 'out')
+            os.makedirs(out)
+            with open(os.path.join(out, 'blocked'), 'wb'):  # A file where the folder should be
+                pass
+
+            errors = []
+
+            async def run():
+                asyncio.get_running_loop().set_exception_handler(lambda loop, context: errors.append(context))
+                async with await AsyncXP3Reader.open(path, jobs=2) as xp3:
+                    with self.assertRaises(OSError):
+                        await xp3.extract(out)
+                    self.assertEqual({asyncio.current_task()}, asyncio.all_tasks())
+                folder = os.path.join(out, 'folder')
+                self.assertLess(len(os.listdir(folder)) if os.path.isdir(folder) else 0, 50)
+
+            asyncio.run(run())
+            self.assertEqual([], errors)
+
+
+class ReadMany(unittest.TestCase):
+    """Batched reads should return the same data as reading the files one by one"""
+
+    def test(self):
+        files = {'file{}'.format(index): os.urandom(index * 1000) + b'dummydata' * index for index in range(30)}
+        with XP3Writer(silent=True, segment_size=8 * 1024) as xp3:
+            for path, data in files.items():
+                xp3.add(path, data, 'neko_vol0')
+            archive = xp3.pack_up()
+
+        requested = ['file{}'.format(index) for index in (29, 3, 0, 17, 3, 8)] + [5]
+        expected = [files[item if isinstance(item, str) else 'file{}'.format(item)] for item in requested]
+        for backend in ('seek', 'mmap'):
+            with XP3Reader(archive, silent=True, backend=backend, cache_size=1024 * 1024) as xp3:
+                for max_gap, max_read in ((0, 1), (64 * 1024, 16 * 1024 * 1024)):
+                    self.assertEqual(expected, xp3.read_many(requested, 'neko_vol0', jobs=3, max_gap=max_gap,
+                                                             max_read=max_read))
+                self.assertEqual(len(requested), xp3.cache.hits)  # Second round came from the cache
+
+                completed = sorted(xp3.read_many(files, 'neko_vol0', ordered=False), key=lambda item: item[0])
+                self.assertEqual(sorted(files.items()), completed)
+                with self.assertRaises(XP3DecryptionError):
+                    xp3.read_many(['file5'])
+
+    def test_bounded(self):
+        """Reading shouldn't run ahead of the consumer by more than a few decodes"""
+        with XP3Writer(silent=True) as xp3:
+            for index in range(100):
+                xp3.add('file{}'.format(index), b'dummydata' * index)
+            archive = xp3.pack_up()
+
+        pool = segment_pool(2)
+        with XP3Reader(archive, silent=True) as xp3, mock.patch.object(pool, 'submit', wraps=pool.submit) as submit:
+            results = xp3.read_many(range(100), ordered=False, jobs=2)
+            next(results)
+            self.assertLessEqual(submit.call_count, 4)
+            self.assertEqual(99, len(list(results)))
+            self.assertEqual(100, submit.call_count)
+
+
+class OrderedExtract(unittest.TestCase):
+    """Files should be extracted in the order their data is in the archive, not the index order"""
+
+    def test(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(path, 'w', silent=True) as xp3:
+                for index in range(20):
+                    xp3.add('folder{}/file{}'.format(index % 3, index), str(index).encode() * 1000, 'neko_vol1')
+                xp3.file_entries.reverse()
+
+            for jobs in (1, 2):
+                out = os.path.join(xp3dir, 'out{}'.format(jobs))
+                output = io.StringIO()
+                with XP3(path, 'r') as xp3, contextlib.redirect_stdout(output):
+                    xp3.extract(out, 'neko_vol1', jobs=jobs)
+                    self.assertEqual(20, xp3.extract_stats['files'])
+                    self.assertEqual(sum(len(str(index)) * 1000 for index in range(20)), xp3.extract_stats['bytes'])
+                extracted = [line.split()[2] for line in output.getvalue().splitlines() if line.startswith('| ')]
+                self.assertEqual(['folder{}/file{}'.format(index % 3, index) for index in range(20)], extracted)
+                self.assertIn('files/s', output.getvalue())
+                with open(os.path.join(out, 'folder1', 'file7'), 'rb') as file:
+                    self.assertEqual(b'7' * 1000, file.read())
+
+    def test_memory(self):
+        """Extracting serially shouldn't hold much more than its read-ahead window, however big the archive"""
+        with tempfile.TemporaryDirectory() as xp3dir:
+            path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(path, 'w', silent=True) as xp3:
+                for index in range(100):
+                    xp3.add('file{}'.format(index), os.urandom(256 * 1024))
+
+            with XP3(path, 'r', silent=True) as xp3:
+                tracemalloc.start()
+                try:
+                    xp3.extract(os.path.join(xp3dir, 'out'))
+                    peak = tracemalloc.get_traced_memory()[1]
+                finally:
+                    tracemalloc.stop()
+            self.assertLess(peak, 3 * XP3.extract_read_ahead)
+            self.assertEqual(100, len(os.listdir(os.path.join(xp3dir, 'out'))))
+
+
+class PathQuery(unittest.TestCase):
+    """Listing, prefix, case-insensitive and glob queries should match scanning every path"""
+    file_paths = ['scenario/first.ks', 'scenario/Second.KS', 'voice/ch03/001.ogg', 'voice/ch03/002.ogg',
+                  'voice/ch031/001.ogg', 'voice/ch04/001.ogg', 'Image/bg.png', 'startup.tjs', 'voice/readme.txt']
+
+    def test(self):
+        with XP3Writer(silent=True) as xp3:
+            for file_path in self.file_paths:
+                xp3.add(file_path, file_path.encode())
+            archive = xp3.pack_up()
+
+        for index_mode in ('eager', 'lazy', 'compact'):
+            with XP3Reader(archive, silent=True, index_mode=index_mode) as xp3:
+                self.assertEqual(['Image', 'scenario', 'startup.tjs', 'voice'], xp3.listdir())
+                self.assertEqual(['ch03', 'ch031', 'ch04', 'readme.txt'], xp3.listdir('VOICE/'))
+                self.assertEqual(['001.ogg', '002.ogg'], xp3.listdir('voice/ch03'))
+                with self.assertRaises(FileNotFoundError):
+                    xp3.listdir('missing')
+
+                self.assertEqual(b'scenario/Second.KS', bytes(xp3.find('SCENARIO/second.ks').read()))
+                with self.assertRaises(KeyError):
+                    xp3.find('scenario/third.ks')
+
+                for pattern in ('*.ks', 'voice/ch03/*', 'voice/*/001.ogg', '*', 'image/BG.png', '*.nothing',
+                                'voice/ch0?/*', '[is]*', 'startup.tjs', 'missing'):
+                    expected = sorted((path for path in self.file_paths
+                                       if fnmatch.fnmatch(path.lower(), pattern.lower())), key=str.lower)
+                    self.assertEqual(expected, xp3.glob(pattern), pattern)
+                self.assertEqual([2, 3], xp3.file_index.paths.prefix('voice/ch03/'))
+
+    def test_extract(self):
+        with tempfile.TemporaryDirectory() as xp3dir:
+            path = os.path.join(xp3dir, 'data.xp3')
+            with XP3(path, 'w', silent=True) as xp3:
+                for file_path in self.file_paths:
+                    xp3.add(file_path, file_path.encode())
+
+            with XP3(path, 'r', silent=True) as xp3:
+                xp3.extract(os.path.join(xp3dir, 'out'), include='voice/ch03/*')
+            out = os.path.join(xp3dir, 'out')
+            extracted = sorted(os.path.relpath(os.path.join(dirpath, filename), out)
+                               for dirpath, _, filenames in os.walk(out) for filename in filenames)
+            self.assertEqual([os.path.join('voice', 'ch03', '001.ogg'), os.path.join('voice', 'ch03', '002.ogg')],
+                             extracted)
+
+
 if __name__ == '__main__':
     unittest.main()
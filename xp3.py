@@ -14,27 +14,75 @@
 
 
 import os
+import time
+import zlib
+import threading
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from xp3reader import XP3Reader
-from xp3writer import XP3Writer
+from xp3writer import XP3Writer, XP3CompressionPolicy
+from structs import XP3File, encryption_parameters
+
+
+_worker = threading.local()
+
+
+def _open_worker_buffer(path, handles=None):
+    """Pool initializer, gives every worker a file handle of its own instead of sharing the seek position"""
+    _worker.buffer = open(path, 'rb')
+    _worker.source = None
+    if handles is not None:
+        handles.append(_worker.buffer)
+
+
+def _share_worker_source(buffer, source):
+    """Pool initializer, lets the workers share a thread-safe source of the archive"""
+    _worker.buffer = buffer
+    _worker.source = source
+
+
+def _extract_entry(entry, to, encryption_type, silent, use_numpy):
+    """Extract a file entry using the worker's file handle, returns False if the file could not be written"""
+    file = XP3File(entry, _worker.buffer, silent, use_numpy, _worker.source)
+    try:
+        file.extract(to=to, encryption_type=encryption_type, makedirs=False)  # Folders are created up front
+    except OSError:  # Usually because of long file names
+        return False
+    return True
 
 
 class XP3(XP3Reader, XP3Writer):
-    def __init__(self, target, mode='r', silent=False):
+    key_check_size = 4096  # Bytes to compare to tell apart encryptions that share the chunk name
+    extract_read_ahead = 4 * 1024 * 1024  # Biggest merged read when extracting serially, bounds the memory used
+
+    def __init__(self, target, mode='r', silent=False, jobs: int = 1, backend: str = 'seek', index_mode: str = 'eager',
+                 index_cache=None, dedup: bool = False, compression: XP3CompressionPolicy = None,
+                 segment_size: int = 0, cache_size: int = 0, pin_size: int = 0):
         self.mode = mode
+        self.baseline_reused = 0  # Files copied from a baseline archive instead of being recompressed
 
         if self._is_readmode:
             if isinstance(target, str):
                 if not os.path.isfile(target):
                     raise FileNotFoundError
                 target = open(target, 'rb')
-            XP3Reader.__init__(self, target, silent)
+            XP3Reader.__init__(self, target, silent, backend=backend, index_mode=index_mode, index_cache=index_cache,
+                               cache_size=cache_size, pin_size=pin_size)
+        elif self._is_appendmode:
+            if isinstance(target, str):
+                if not os.path.isfile(target):
+                    raise FileNotFoundError
+                target = open(target, 'r+b')
+            XP3Writer.__init__(self, target, silent, jobs=jobs, append=True, dedup=dedup, compression=compression,
+                               segment_size=segment_size)
         elif self._is_writemode:
             if isinstance(target, str):
                 dir = os.path.dirname(target)
                 if dir and not os.path.exists(dir):
                     os.makedirs(dir)
                 target = open(target, 'wb')
-            XP3Writer.__init__(self, target, silent)
+            XP3Writer.__init__(self, target, silent, jobs=jobs, dedup=dedup, compression=compression,
+                               segment_size=segment_size)
         else:
             raise ValueError('Invalid operation mode')
 
@@ -44,30 +92,130 @@ class XP3(XP3Reader, XP3Writer):
 
     @property
     def _is_writemode(self):
-        return True if self.mode == 'w' else False
+        return True if self.mode in ('w', 'a') else False
 
-    def extract(self, to='', encryption_type='none'):
-        """Extract all files in the archive to specified folder"""
+    @property
+    def _is_appendmode(self):
+        return True if self.mode == 'a' else False
+
+    def extract(self, to='', encryption_type='none', jobs: int = 1, use_processes: bool = False, include: str = None):
+        """
+        Extract all files in the archive to specified folder, in the order their data is in the archive,
+        the summary of how long it took is kept in extract_stats
+        :param to: Folder to extract into (if not specified, archive name is used)
+        :param encryption_type: Encryption type to decrypt with
+        :param jobs: Number of workers to decompress, decrypt and write the files with
+        :param use_processes: Use a process pool instead of a thread pool
+        :param include: Only extract the files matching this shell-style pattern (e.g. voice/ch03/* or *.ks)
+        """
         if not self._is_readmode:
             raise Exception('Archive is not open in reading mode')
 
-        for file in self:
-            try:
-                if not self.silent:
-                    print('| Extracting {} ({} -> {} bytes)'.format(file.file_path,
-                                                                    file.info.compressed_size,
-                                                                    file.info.uncompressed_size))
-                file.extract(to=to, encryption_type=encryption_type)
-            except OSError:  # Usually because of long file names
-                if not self.silent:
-                    print('! Problem writing {}'.format(file.file_path))
+        if not to:
+            # Use archive name as output folder if it's not explicitly specified
+            to = os.path.splitext(os.path.basename(self.buffer.name))[0]
+
+        # Files are extracted in the order their data is in the archive, so the archive is read front to back
+        entries = self.file_index.entries
+        positions = self.file_index.paths.glob(include) if include else range(len(entries))
+        order = [position for _, position in sorted((entries[position].segm.segments[0].offset, position)
+                                                    for position in positions)]
+        self._make_directories(to, [entries[position] for position in order])
+
+        started = time.perf_counter()
+        # Workers either share a thread-safe source or open their own handles, which needs an actual file on disk
+        if jobs > 1 and (self.source.thread_safe and not use_processes or hasattr(self.buffer, 'name')):
+            written = self._extract_parallel(to, encryption_type, jobs, use_processes, order)
+        else:
+            written = 0
+            # Segments are read ahead in merged reads of bounded size and decoded while the files are written
+            for position, data in self.read_many(order, encryption_type, ordered=False, jobs=1,
+                                                 max_read=self.extract_read_ahead):
+                file = self.open(position)
+                try:
+                    if not self.silent:
+                        print('| Extracting {} ({} -> {} bytes)'.format(file.file_path,
+                                                                        file.info.compressed_size,
+                                                                        file.info.uncompressed_size))
+                    file.save(data, to=to, makedirs=False)
+                    written += file.info.uncompressed_size
+                except OSError:  # Usually because of long file names
+                    if not self.silent:
+                        print('! Problem writing {}'.format(file.file_path))
+
+        seconds = max(time.perf_counter() - started, 1e-9)
+        self.extract_stats = {'files': len(order), 'bytes': written, 'seconds': seconds,
+                              'files_per_second': len(order) / seconds,
+                              'mb_per_second': written / seconds / 1024 / 1024}
+        if not self.silent:
+            print('Extracted {files} file(s), {bytes} bytes in {seconds:.2f}s '
+                  '({files_per_second:.0f} files/s, {mb_per_second:.1f} MB/s)'.format(**self.extract_stats))
         return self
 
-    def add_folder(self, path, flatten: bool = False, encryption_type: str = None, save_timestamps: bool = False):
+    @staticmethod
+    def _make_directories(to, entries):
+        """Create the folders for all files at once, instead of checking for them file by file"""
+        for directory in sorted({os.path.dirname(os.path.join(to, entry.file_path)) for entry in entries}):
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except OSError:  # Reported when writing the files in it fails
+                pass
+
+    def _extract_parallel(self, to, encryption_type, jobs, use_processes, order) -> int:
+        """Extract the files in the given order with a pool of workers, returns the number of bytes written"""
+        path = getattr(self.buffer, 'name', None)
+        handles = []
+        if use_processes:
+            executor = ProcessPoolExecutor(jobs, initializer=_open_worker_buffer, initargs=(path,))
+        elif self.source.thread_safe:
+            executor = ThreadPoolExecutor(jobs, initializer=_share_worker_source, initargs=(self.buffer, self.source))
+        else:
+            executor = ThreadPoolExecutor(jobs, initializer=_open_worker_buffer, initargs=(path, handles))
+
+        entries = [self.file_index.entries[position] for position in order]
+        bytes_written = 0
+        try:
+            with executor:
+                results = executor.map(_extract_entry, entries, repeat(to), repeat(encryption_type),
+                                       repeat(self.silent), repeat(self.use_numpy),
+                                       chunksize=64 if use_processes else 1)
+                for entry, written in zip(entries, results):
+                    if written:
+                        bytes_written += entry.info.uncompressed_size
+                    if self.silent:
+                        continue
+                    print('| Extracting {} ({} -> {} bytes)'.format(entry.file_path,
+                                                                    entry.info.compressed_size,
+                                                                    entry.info.uncompressed_size))
+                    if not written:
+                        print('! Problem writing {}'.format(entry.file_path))
+        finally:
+            for handle in handles:
+                handle.close()
+        return bytes_written
+
+    def add_folder(self, path, flatten: bool = False, encryption_type: str = None, save_timestamps: bool = False,
+                   baseline=None, verify_baseline: bool = False, compression: XP3CompressionPolicy = None):
+        """
+        :param path: Path to folder
+        :param flatten: Ignore the subdirectories and pack all files as if they are in the root folder
+        :param encryption_type: Encryption type to use
+        :param save_timestamps: Save the file creating time into archive or not
+        :param baseline: Previous build of the archive (path or XP3Reader), unchanged files are copied from it
+                         without recompressing
+        :param verify_baseline: Compare the contents of files matching the baseline by size and checksum
+        :param compression: Compression policy for these files instead of the archive's one
+        """
         if not self._is_writemode:
             raise Exception('Archive is not open in writing mode')
+        if isinstance(baseline, str):
+            with XP3Reader(open(baseline, 'rb'), silent=True) as baseline:
+                return self.add_folder(path, flatten, encryption_type, save_timestamps, baseline, verify_baseline,
+                                       compression)
         if not self.silent:
             print('Packing {}'.format(path))
+
+        baseline_reused = self.baseline_reused
         for dirpath, dirs, filenames in os.walk(path):
             # Strip off the base directory and possible slash
             internal_root = dirpath[len(path) + 1:]
@@ -79,14 +227,23 @@ class XP3(XP3Reader, XP3Writer):
                 internal_filepath = internal_root + '/' + filename \
                                     if internal_root and not flatten \
                                     else filename
-                self.add_file(os.path.join(dirpath, filename), internal_filepath, encryption_type, save_timestamps)
+                self.add_file(os.path.join(dirpath, filename), internal_filepath, encryption_type, save_timestamps,
+                              baseline, verify_baseline, compression)
+        if baseline:
+            self._flush_in_flight()  # Copies queued behind the workers still read from the baseline
+            if not self.silent:
+                print('Reused {} unchanged file(s) from the baseline'.format(self.baseline_reused - baseline_reused))
 
-    def add_file(self, path, internal_filepath: str = None, encryption_type: str = None, save_timestamps: bool = False):
+    def add_file(self, path, internal_filepath: str = None, encryption_type: str = None, save_timestamps: bool = False,
+                 baseline: XP3Reader = None, verify_baseline: bool = False, compression: XP3CompressionPolicy = None):
         """
         :param path: Path to file
         :param internal_filepath: Internal archive path to save file under (if not specified, file name is used)
         :param encryption_type: Encryption type to use
         :param save_timestamps: Save the file creating time into archive or not
+        :param baseline: Previous build of the archive, if it has the same file it's copied without recompressing
+        :param verify_baseline: Compare the contents of a file matching the baseline by size and checksum
+        :param compression: Compression policy for this file instead of the archive's one
         """
         if not self._is_writemode:
             raise Exception('Archive is not open in writing mode')
@@ -94,13 +251,62 @@ class XP3(XP3Reader, XP3Writer):
         if not os.path.exists(path):
             raise FileNotFoundError
 
+        timestamp = 0 if not save_timestamps else round(os.path.getctime(path) * 1000)
         with open(path, 'rb') as buffer:
-            data = buffer.read()
             if not internal_filepath:
                 internal_filepath = os.path.basename(buffer.name)
+            size = os.fstat(buffer.fileno()).st_size
 
-        timestamp = 0 if not save_timestamps else round(os.path.getctime(path) * 1000)
-        super().add(internal_filepath, data, encryption_type, timestamp)
+            if baseline and internal_filepath in baseline.file_index.path_index:
+                file = baseline.open(internal_filepath)
+                if self._matches_baseline(buffer, size, file, encryption_type, verify_baseline):
+                    self.add_raw_entry(file, timestamp)
+                    self.baseline_reused += 1
+                    return
+
+            # Small files are read whole so they can go through the worker pool, big ones are streamed in chunks
+            if size <= self.stream_threshold:
+                super().add(internal_filepath, buffer.read(), encryption_type, timestamp, compression)
+            else:
+                super().add(internal_filepath, buffer, encryption_type, timestamp, compression)
+
+    def _matches_baseline(self, buffer, size: int, file: XP3File, encryption_type: str, verify: bool) -> bool:
+        """
+        Check if the file in the baseline archive holds the same data with the same encryption,
+        by size and Adler-32 checksum and optionally by comparing the contents, leaves the buffer at the start.
+        Encryptions can share the chunk name (neko_vol1 and neko_vol1_steam do), so the start of an encrypted file
+        is always decrypted and compared to make sure it was encrypted with the same key
+        """
+        if file.info.uncompressed_size != size:
+            return False
+        if encryption_type in ('none', None):
+            if file.is_encrypted:
+                return False
+        elif not file.is_encrypted or file.encryption.name != encryption_parameters[encryption_type][3]:
+            return False
+
+        adler32 = zlib.adler32(b'')
+        for chunk in iter(lambda: buffer.read(self.stream_chunk_size), b''):
+            adler32 = zlib.adler32(chunk, adler32)
+        buffer.seek(0)
+        if adler32 != file.adler32:
+            return False
+
+        if file.is_encrypted and not verify:
+            try:
+                if file.read_range(0, self.key_check_size, encryption_type) != buffer.read(self.key_check_size):
+                    return False
+            finally:
+                buffer.seek(0)
+
+        if verify:
+            try:
+                for chunk in file.iter_chunks(encryption_type or 'none', chunk_size=self.stream_chunk_size):
+                    if buffer.read(len(chunk)) != chunk:
+                        return False
+            finally:
+                buffer.seek(0)
+        return True
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Write the file index in the archive as we leave the context manager"""
@@ -108,11 +314,12 @@ class XP3(XP3Reader, XP3Writer):
             if not self.packed_up:
                 self.pack_up()
             self.buffer.close()
+        else:
+            self.close()
 
 
 if __name__ == '__main__':
     import argparse
-    from structs.encryption_parameters import encryption_parameters
 
     def input_filepath(path: str) -> str:
         if not os.path.exists(os.path.realpath(path)):
@@ -121,23 +328,52 @@ if __name__ == '__main__':
 
 
     parser = argparse.ArgumentParser(description='KiriKiri .XP3 archive repacking and extraction tool')
-    parser.add_argument('-mode', '-m', choices=['e', 'r', 'extract', 'repack'], default='e', help='Operation mode')
+    parser.add_argument('-mode', '-m', choices=['e', 'r', 'u', 'extract', 'repack', 'update'], default='e', help='Operation mode')
     parser.add_argument('-silent', '-s', action='store_true', default=False)
     parser.add_argument('-flatten', '-f', action='store_true', default=False,
                         help='Ignore the subdirectories and pack the archive as if all files are in the root folder')
     parser.add_argument('--dump-index', '-i', action='store_true', help='Dump the file index of an archive')
     parser.add_argument('-encryption', '-e', choices=encryption_parameters.keys(), default='none',
                         help='Specify the encryption method')
+    parser.add_argument('--jobs', '-j', type=int, default=1,
+                        help='Number of parallel workers to extract or pack with')
+    parser.add_argument('--baseline', '-b', type=input_filepath,
+                        help='Previous build of the archive to copy unchanged files from when repacking')
+    parser.add_argument('--dedup', '-d', action='store_true', default=False,
+                        help='Store files with identical contents only once when packing')
+    parser.add_argument('--level', '-l', type=int, choices=range(10), default=9,
+                        help='Compression level for files without an extension rule, 0 stores everything')
+    parser.add_argument('--store', action='append', metavar='EXT',
+                        help='File extension to store uncompressed, repeat for more, e.g. --store .ogg --store .png')
+    parser.add_argument('--fast', action='append', metavar='EXT',
+                        help='File extension to compress at the fastest level, repeat for more')
+    parser.add_argument('--max', action='append', metavar='EXT',
+                        help='File extension to compress at the best level, repeat for more')
+    parser.add_argument('--probe', type=int, default=0, metavar='KB',
+                        help='Store files whose first KB kilobytes do not compress instead of compressing them whole')
+    parser.add_argument('--segment-size', type=int, default=0, metavar='MB',
+                        help='Split bigger files into segments that can be compressed and decompressed in parallel')
+    parser.add_argument('--include', metavar='GLOB',
+                        help='Only extract the files matching this pattern, e.g. voice/ch03/* or *.ks')
     parser.add_argument('input', type=input_filepath, help='File to unpack or folder to pack')
     parser.add_argument('output', help='Output folder to unpack into or output file to pack into')
     args = parser.parse_args()
+    compression = XP3CompressionPolicy(args.level,
+                                       {extension: rule for rule in XP3CompressionPolicy.levels
+                                        for extension in getattr(args, rule) or ()},
+                                       args.probe * 1024)
 
     if args.mode in ('e', 'extract'):
         with XP3(args.input, 'r', args.silent) as xp3:
             if args.dump_index:
                 xp3.file_index.extract(args.output)
             else:
-                xp3.extract(args.output, args.encryption)
+                xp3.extract(args.output, args.encryption, args.jobs, include=args.include)
     elif args.mode in ('r', 'repack'):
-        with XP3(args.output, 'w', args.silent) as xp3:
+        with XP3(args.output, 'w', args.silent, args.jobs, dedup=args.dedup, compression=compression,
+                 segment_size=args.segment_size * 1024 * 1024) as xp3:
+            xp3.add_folder(args.input, args.flatten, args.encryption, baseline=args.baseline)
+    elif args.mode in ('u', 'update'):
+        with XP3(args.output, 'a', args.silent, args.jobs, dedup=args.dedup, compression=compression,
+                 segment_size=args.segment_size * 1024 * 1024) as xp3:
             xp3.add_folder(args.input, args.flatten, args.encryption)
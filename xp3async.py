@@ -0,0 +1,132 @@
+import os
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from xp3reader import XP3Reader
+from structs import XP3File
+from structs.constants import XP3FileStreamChunkSize
+
+
+class AsyncXP3Reader:
+    """
+    asyncio front for an archive, reading, decompressing and decrypting runs on a bounded pool of worker threads.
+    Every job holds one of a limited number of slots, big files are read in chunk sized jobs
+    that queue up for a slot each, so they can't hold up small files behind them.
+    Cancelling a request stops it at its next job
+    """
+
+    def __init__(self, reader: XP3Reader, jobs: int = 4, chunk_size: int = 1024 * 1024, max_pending: int = None):
+        """
+        :param reader: Archive to read, its backend has to be safe to read from many threads ('mmap' or 'pread')
+        :param jobs: Number of worker threads
+        :param chunk_size: Files bigger than this are read in jobs of this size
+        :param max_pending: Maximum number of jobs handed to the workers at once, twice the jobs by default
+        """
+        if not reader.source.thread_safe:
+            raise ValueError('Archive has to be read with a thread-safe backend')
+        self.reader = reader
+        self.chunk_size = chunk_size
+        self.max_pending = max_pending or jobs * 2
+        self._executor = ThreadPoolExecutor(jobs)
+        self._slots = asyncio.Semaphore(self.max_pending)
+
+    @classmethod
+    async def open(cls, path: str, jobs: int = 4, backend: str = 'pread', chunk_size: int = 1024 * 1024,
+                   max_pending: int = None, **kwargs):
+        """
+        Open an archive without blocking the event loop
+        :param path: Path to the archive
+        :param jobs: Number of worker threads
+        :param backend: Thread-safe backend to read with, 'pread' or 'mmap'
+        :param chunk_size: Files bigger than this are read in jobs of this size
+        :param max_pending: Maximum number of jobs handed to the workers at once, twice the jobs by default
+        :param kwargs: Other XP3Reader arguments
+        """
+        def open_reader():
+            buffer = open(path, 'rb')
+            try:
+                return XP3Reader(buffer, silent=True, backend=backend, **kwargs)
+            except Exception:
+                buffer.close()
+                raise
+
+        return cls(await asyncio.get_running_loop().run_in_executor(None, open_reader), jobs, chunk_size, max_pending)
+
+    async def _run(self, function, *args):
+        """Run a job on the workers once there is a free slot"""
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    def file(self, item) -> XP3File:
+        """Access a file by its internal file path or position in file index, doesn't touch the archive data"""
+        return self.reader.open(item)
+
+    async def read(self, item, encryption_type='none'):
+        """Read a file, big files are read chunk by chunk"""
+        file = self.file(item)
+        if file.info.uncompressed_size <= self.chunk_size:
+            return await self._run(file.read, encryption_type)
+        data = bytearray()
+        async for chunk in self.iter_chunks(file, encryption_type):
+            data += chunk
+        return data
+
+    async def iter_chunks(self, item, encryption_type='none', chunk_size: int = None):
+        """Yield the data of a file in chunks of at most chunk_size bytes, each one read as a separate job"""
+        file = item if isinstance(item, XP3File) else self.file(item)
+        chunk_size = chunk_size or self.chunk_size
+        stream = file.open_stream(encryption_type, chunk_size=min(chunk_size, XP3FileStreamChunkSize))
+        try:
+            while True:
+                chunk = await self._run(stream.read, chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            stream.close()
+
+    async def extract(self, to: str, encryption_type='none'):
+        """
+        Extract all files in the archive to the specified folder, with as many files written concurrently
+        as there are slots, the first file that fails stops the others
+        """
+        async def extract_file(file: XP3File):
+            if file.info.uncompressed_size <= self.chunk_size:
+                return await self._run(file.extract, to, None, encryption_type)
+
+            path = os.path.join(to, file.file_path)
+            await self._run(lambda: os.makedirs(os.path.dirname(path), exist_ok=True))
+            output = await self._run(open, path, 'wb')
+            try:
+                async for chunk in self.iter_chunks(file, encryption_type):
+                    await self._run(output.write, chunk)
+            finally:
+                await self._run(output.close)
+
+        files = iter(self.reader)
+
+        async def extract_files():
+            for file in files:  # Shared by all of them, each one takes the next file when it's done
+                await extract_file(file)
+
+        tasks = [asyncio.ensure_future(extract_files()) for _ in range(self.max_pending)]
+        try:
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+    async def close(self):
+        """Drop the queued jobs, wait for the running ones and close the archive"""
+        def close():
+            self._executor.shutdown(cancel_futures=True)
+            self.reader.close()
+
+        await asyncio.get_running_loop().run_in_executor(None, close)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
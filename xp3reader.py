@@ -1,26 +1,59 @@
+import os
 from io import BytesIO
-from structs import XP3Signature, XP3FileIndex, XP3File
+from concurrent.futures import FIRST_COMPLETED, as_completed, wait
+from structs import XP3Signature, XP3FileIndex, XP3File, XP3ContentCache, backends
+from structs.file import segment_pool
 
 
 class XP3Reader:
-    def __init__(self, buffer, silent: bool = False, use_numpy: bool = True):
+    def __init__(self, buffer, silent: bool = False, use_numpy: bool = True, backend: str = 'seek',
+                 index_mode: str = 'eager', index_cache=None, cache_size: int = 0, pin_size: int = 0):
+        """
+        :param buffer: Buffer object or bytes to read the archive from
+        :param silent: Supress prints
+        :param use_numpy: Use Numpy for XORing if available
+        :param backend: How to read the archive, 'seek' (seek and read on the buffer),
+                        'mmap' (memory map the archive) or 'pread' (positional reads),
+                        the latter two are safe to read from many threads at once
+        :param index_mode: How to read the file index, 'eager' (parse every entry up front),
+                           'lazy' (only scan for file paths, parse entries when accessed)
+                           or 'compact' (keep the index in arrays, create entries when accessed)
+        :param index_cache: Path to a file to cache the compact index in, or True to put it next to the archive,
+                            implies the compact index mode, the cache is rebuilt when the archive changes
+        :param cache_size: Keep up to this many bytes of decoded files in memory, so reading them again is a lookup,
+                           0 to not cache anything
+        :param pin_size: Never evict cached files of up to this many bytes
+        """
         if isinstance(buffer, bytes):
             buffer = BytesIO(buffer)
+        if backend not in backends:
+            raise ValueError('Unknown backend {}'.format(backend))
+        if index_mode not in ('eager', 'lazy', 'compact'):
+            raise ValueError('Unknown index mode {}'.format(index_mode))
 
         self.buffer = buffer
         self.silent = silent
         self.use_numpy = use_numpy
+        self.cache = XP3ContentCache(cache_size, pin_size) if cache_size else None
 
         if XP3Signature != self.buffer.read(len(XP3Signature)):
             raise AssertionError('Is not an XP3 file')
+        self.source = backends[backend](buffer)
 
         if not silent:
             print('Reading the file index', end='')
-        self.file_index = XP3FileIndex.read_from(self.buffer)
+        view = getattr(self.source, 'view', None)
+        if index_cache and hasattr(self.buffer, 'name'):
+            if index_cache is True:
+                index_cache = self.buffer.name + '.idx'
+            self.file_index = XP3FileIndex.read_cached(self.buffer, index_cache, view)
+        else:
+            self.file_index = XP3FileIndex.read_from(self.buffer, view, index_mode)
         if not silent:
             print(', found {} file(s)'.format(len(self.file_index.entries)))
 
     def close(self):
+        self.source.close()
         self.buffer.close()
 
     def __enter__(self):
@@ -40,7 +73,108 @@ class XP3Reader:
 
     def __getitem__(self, item):
         """Access a file by it's internal file path or position in file index"""
-        return XP3File(self.file_index[item], self.buffer, self.silent, self.use_numpy)
+        file = XP3File(self.file_index[item], self.buffer, self.silent, self.use_numpy, self.source)
+        if self.cache is not None:
+            # Cached by position in the file index, the same file can be opened by path or position
+            if isinstance(item, str):
+                item = self.file_index.path_index[item]
+            file.cache = self.cache
+            file.cache_key = item % len(self.file_index.entries)
+        return file
 
     def open(self, item):
         return self.__getitem__(item)
+
+    def find(self, file_path: str) -> XP3File:
+        """Access a file by its internal file path, ignoring case like the engine does"""
+        return self.open(self.file_index.paths.find(file_path))
+
+    def listdir(self, directory: str = '') -> list:
+        """Names of the files and folders in a folder of the archive"""
+        return self.file_index.paths.listdir(directory)
+
+    def glob(self, pattern: str) -> list:
+        """Internal file paths matching a shell-style pattern (e.g. voice/ch03/* or *.ks), ignoring case"""
+        file_paths = self.file_index.paths.file_paths
+        return [file_paths[position] for position in self.file_index.paths.glob(pattern)]
+
+    def read_many(self, items, encryption_type='none', ordered: bool = True, jobs: int = None,
+                  max_gap: int = 64 * 1024, max_read: int = 16 * 1024 * 1024):
+        """
+        Read many files at once, their segments are read in the order they are in the archive,
+        with segments close to each other merged into one bigger read, and decoded in parallel
+        :param items: Internal file paths or positions in the file index
+        :param encryption_type: Encryption type to decrypt with
+        :param ordered: Return a list of the data in the order the files were asked for,
+                        otherwise a generator of file and its data as each one is decoded
+        :param jobs: Number of workers to decode with, one per CPU if not specified
+        :param max_gap: Merge segments with up to this many bytes between them into one read
+        :param max_read: Don't merge segments into reads bigger than this
+        """
+        items = list(items)
+        results = self._read_many(items, encryption_type, jobs or os.cpu_count() or 1, max_gap, max_read)
+        if not ordered:
+            return ((items[position], data) for position, data in results)
+
+        output = [None] * len(items)
+        for position, data in results:
+            output[position] = data
+        return output
+
+    def _read_many(self, items, encryption_type, jobs, max_gap, max_read):
+        """
+        Yield the position of each file in the request and its data, as they get decoded,
+        with at most twice the jobs decodes in flight so reading doesn't run ahead of the consumer
+        """
+        files = [self.open(item) for item in items]
+        segments = []  # Offset, size, file position, segment position
+        missing = []  # Segments yet to read per file
+        for position, file in enumerate(files):
+            if file.cache is not None:
+                data = file.cache.get(file._cache_key(encryption_type))
+                if data is not None:
+                    missing.append(0)
+                    yield position, data
+                    continue
+            for number, segment in enumerate(file.segm):
+                segments.append((segment.offset, segment.compressed_size, position, number))
+            missing.append(len(file.segm.segments))
+        segments.sort()
+
+        read = [[None] * count for count in missing]
+        pool = segment_pool(jobs)
+        pending = {}  # Future -> file position
+        max_pending = jobs * 2
+        start = 0
+        while start < len(segments):
+            # Merge the following segments as long as they are close enough
+            end = start + 1
+            range_start = segments[start][0]
+            range_end = range_start + segments[start][1]
+            while end < len(segments):
+                offset, size, _, _ = segments[end]
+                if offset - range_end > max_gap or max(range_end, offset + size) - range_start > max_read:
+                    break
+                range_end = max(range_end, offset + size)
+                end += 1
+
+            data = memoryview(self.source.read(range_start, range_end - range_start))
+            if len(data) != range_end - range_start:
+                raise AssertionError('Unexpected end of archive')
+            for offset, size, position, number in segments[start:end]:
+                read[position][number] = data[offset - range_start:offset - range_start + size]
+                missing[position] -= 1
+                if not missing[position]:
+                    while len(pending) >= max_pending:
+                        wait(pending, return_when=FIRST_COMPLETED)
+                        for future in [future for future in pending if future.done()]:
+                            yield pending.pop(future), future.result()
+                    pending[pool.submit(files[position].decode, read[position], encryption_type)] = position
+                    read[position] = None
+            start = end
+
+            for future in [future for future in pending if future.done()]:
+                yield pending.pop(future), future.result()
+
+        for future in as_completed(pending):
+            yield pending[future], future.result()
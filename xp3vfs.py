@@ -0,0 +1,176 @@
+import os
+import re
+import threading
+from collections import OrderedDict
+from xp3reader import XP3Reader
+from structs.file import XP3FileStream
+
+
+class XP3VirtualFS:
+    """
+    Archives and loose folders mounted in priority order and resolved as one file system,
+    later mounts override earlier ones the way patch.xp3 overrides data.xp3 in the engine.
+    All paths go into a single lookup table, matched case-insensitively like the engine does.
+    Archives are only opened to read files from them, with the number of open archives bounded.
+    Reads and open files lease their archive, an archive evicted while leased is closed once the last lease ends
+    """
+
+    def __init__(self, max_open: int = 16, backend: str = 'pread', index_mode: str = 'compact', index_cache=None,
+                 use_numpy: bool = True):
+        """
+        :param max_open: Maximum number of archives to keep open, the least recently used one is closed first
+        :param backend: How to read the archives, see XP3Reader, has to be thread-safe to read from many threads
+        :param index_mode: How to read the file indexes, see XP3Reader
+        :param index_cache: Cache the file indexes next to the archives (True) to make mounting and reopening cheap
+        :param use_numpy: Use Numpy for XORing if available
+        """
+        if max_open < 1:
+            raise ValueError('At least one archive has to be kept open')
+        self.max_open = max_open
+        self.backend = backend
+        self.index_mode = index_mode
+        self.index_cache = index_cache
+        self.use_numpy = use_numpy
+        self.mounts = []  # Archive file or folder paths, in priority order
+        self._folders = set()  # Mount positions of the loose folders
+        self._table = {}  # Lowercase path -> mount position, path in the archive or on disk
+        self._open = OrderedDict()  # Mount position -> XP3Reader, least recently used first
+        self._leases = {}  # XP3Reader -> number of reads and open files using it
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def normalize(path: str) -> str:
+        return path.replace('\\', '/').lstrip('/').lower()
+
+    def mount(self, path: str):
+        """Mount an archive or a loose folder over everything mounted before"""
+        mount = len(self.mounts)
+        if os.path.isdir(path):
+            self._folders.add(mount)
+            paths = {}
+            for dirpath, _, filenames in os.walk(path):
+                for filename in filenames:
+                    filepath = os.path.join(dirpath, filename)
+                    paths[os.path.relpath(filepath, path).replace(os.sep, '/')] = filepath
+        else:
+            with self._reader(path) as xp3:
+                paths = {file_path: file_path for file_path in xp3.file_index.path_index}
+        self.mounts.append(path)
+
+        for internal_filepath, location in paths.items():
+            self._table[self.normalize(internal_filepath)] = mount, location
+        return self
+
+    def mount_patches(self, folder: str, base: str = 'data.xp3'):
+        """Mount the base archive of a game folder, then its patch.xp3, patch2.xp3, ... in order"""
+        self.mount(os.path.join(folder, base))
+        patches = {}
+        for filename in os.listdir(folder):
+            match = re.fullmatch(r'patch(\d*)\.xp3', filename, re.IGNORECASE)
+            if match:
+                patches[int(match.group(1) or 1)] = filename
+        for _, filename in sorted(patches.items()):
+            self.mount(os.path.join(folder, filename))
+        return self
+
+    def _reader(self, path: str) -> XP3Reader:
+        return XP3Reader(open(path, 'rb'), silent=True, use_numpy=self.use_numpy, backend=self.backend,
+                         index_mode=self.index_mode, index_cache=self.index_cache)
+
+    def _acquire(self, mount: int) -> XP3Reader:
+        """Lease an open archive, opening it and evicting the least recently used one if needed"""
+        with self._lock:
+            xp3 = self._open.get(mount)
+            if xp3:
+                self._open.move_to_end(mount)
+            else:
+                while len(self._open) >= self.max_open:
+                    _, evicted = self._open.popitem(last=False)
+                    if evicted not in self._leases:  # Leased ones are closed when released
+                        evicted.close()
+                xp3 = self._open[mount] = self._reader(self.mounts[mount])
+            self._leases[xp3] = self._leases.get(xp3, 0) + 1
+            return xp3
+
+    def _release(self, xp3: XP3Reader):
+        """End a lease, closing the archive if it was evicted or the file system closed meanwhile"""
+        with self._lock:
+            self._leases[xp3] -= 1
+            if not self._leases[xp3]:
+                del self._leases[xp3]
+                if xp3 not in self._open.values():
+                    xp3.close()
+
+    def resolve(self, path: str) -> (str, str):
+        """
+        Find where a file comes from
+        :return Archive or folder it's in and its path in the archive or on disk
+        """
+        mount, location = self._table[self.normalize(path)]
+        return self.mounts[mount], location
+
+    def read(self, path: str, encryption_type='none') -> bytes:
+        """Read a file from whichever mount it resolves to"""
+        mount, location = self._table[self.normalize(path)]
+        if mount in self._folders:
+            with open(location, 'rb') as file:
+                return file.read()
+        xp3 = self._acquire(mount)
+        try:
+            return xp3.open(location).read(encryption_type)
+        finally:
+            self._release(xp3)
+
+    def open(self, path: str, encryption_type='none'):
+        """
+        Open a file for reading as a file-like object,
+        a file in an archive keeps the archive open until the file is closed
+        """
+        mount, location = self._table[self.normalize(path)]
+        if mount in self._folders:
+            return open(location, 'rb')
+        xp3 = self._acquire(mount)
+        try:
+            return XP3LeasedStream(xp3.open(location), encryption_type, release=lambda: self._release(xp3))
+        except BaseException:
+            self._release(xp3)
+            raise
+
+    def __contains__(self, path):
+        return self.normalize(path) in self._table
+
+    def __iter__(self):
+        """Paths of all files, lowercase"""
+        return iter(self._table)
+
+    def __len__(self):
+        return len(self._table)
+
+    def close(self):
+        """Close the open archives, the ones still leased are closed when released"""
+        with self._lock:
+            while self._open:
+                _, xp3 = self._open.popitem()
+                if xp3 not in self._leases:
+                    xp3.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class XP3LeasedStream(XP3FileStream):
+    """File stream that holds a lease on its archive, released when the stream is closed"""
+
+    def __init__(self, file, encryption_type='none', release=None):
+        self._release = None  # Not leased until the stream is set up
+        super().__init__(file, encryption_type)
+        self._release = release
+
+    def close(self):
+        if not self.closed and self._release:
+            release, self._release = self._release, None
+            release()
+        super().close()
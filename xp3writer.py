@@ -1,29 +1,156 @@
+import io
+import os
 import zlib
 import struct
+import itertools
+import time
 import hashlib
+import tempfile
+import threading
 from io import BytesIO
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from structs import XP3FileIndex, XP3FileEncryption, XP3FileTime, XP3FileAdler, XP3FileSegments, XP3FileInfo, XP3File, \
     XP3FileEntry, XP3Signature, encryption_parameters
 
 
+class XP3CompressionPolicy:
+    """
+    Decides how hard to compress each file, by a global level, rules per file extension
+    and a probe that compresses a sample of the file first and stores it as is if the sample doesn't shrink.
+    Time spent and sizes are tallied per rule, see report()
+    """
+    levels = {'store': 0, 'fast': 1, 'max': 9}  # Rule names, level 0 means the file is stored without compressing
+
+    def __init__(self, level: int = 9, rules: dict = None, probe_size: int = 0, probe_ratio: float = 0.95):
+        """
+        :param level: Compression level (0-9) for files without a rule
+        :param rules: Rule (store, fast, max) or compression level by file extension, e.g. {'.ogg': 'store'}
+        :param probe_size: Size of the sample to probe files with, 0 to compress everything
+        :param probe_ratio: Store files with a sample that compresses worse than this ratio
+        """
+        if not 0 <= level <= 9:
+            raise ValueError('Compression level must be between 0 and 9')
+        self.level = level
+        self.rules = {}
+        for extension, rule in (rules or {}).items():
+            if rule not in self.levels and rule not in range(10):
+                raise ValueError('Unknown compression rule {}'.format(rule))
+            self.rules[extension.lower() if extension.startswith('.') else '.' + extension.lower()] = rule
+        self.probe_size = probe_size
+        self.probe_ratio = probe_ratio
+        self.stats = {}  # Rule -> [files, seconds, uncompressed bytes, compressed bytes]
+        self._lock = threading.Lock()
+
+    def choose(self, internal_filepath: str, sample: bytes = b'') -> (str, int):
+        """
+        Pick the compression level for a file
+        :param internal_filepath: Internal file path, its extension selects the rule
+        :param sample: Start of the file data to probe (at least probe_size bytes if there are that many)
+        :return Rule name and compression level, 0 meaning store
+        """
+        rule = self.rules.get(os.path.splitext(internal_filepath)[1].lower())
+        if rule is not None:
+            return str(rule), self.levels.get(rule, rule)
+        if self.level and self.probe_size and len(sample) >= self.probe_size:
+            sample = sample[:self.probe_size]
+            if len(zlib.compress(sample, level=1)) >= len(sample) * self.probe_ratio:
+                return 'probed', 0
+        return 'default', self.level
+
+    def compress(self, internal_filepath: str, data) -> bytes:
+        """Compress the data as the policy says, returns None if it should be stored"""
+        start = time.perf_counter()
+        name, level = self.choose(internal_filepath, data)
+        compressed = zlib.compress(data, level=level) if level else None
+        self.record(name, time.perf_counter() - start, len(data), len(compressed) if compressed else len(data))
+        return compressed
+
+    def record(self, name: str, seconds: float, uncompressed_size: int, compressed_size: int):
+        with self._lock:
+            stats = self.stats.setdefault(name, [0, 0.0, 0, 0])
+            stats[0] += 1
+            stats[1] += seconds
+            stats[2] += uncompressed_size
+            stats[3] += min(compressed_size, uncompressed_size)  # Files that didn't shrink get stored
+
+    def report(self) -> str:
+        """Summary of the time spent and space saved per rule"""
+        return '\n'.join('{}: {} file(s), {:.2f}s, {} -> {} bytes'.format(name, *stats)
+                         for name, stats in sorted(self.stats.items()))
+
+
 class XP3Writer:
-    def __init__(self, buffer: BytesIO = None, silent: bool = False, use_numpy: bool = True):
+    stream_chunk_size = 1024 * 1024  # Chunk size to read, encrypt and compress streamed files in
+    stream_threshold = 16 * 1024 * 1024  # Bigger files are streamed instead of being held in memory
+
+    def __init__(self, buffer: BytesIO = None, silent: bool = False, use_numpy: bool = True, jobs: int = 1,
+                 max_in_flight: int = 256 * 1024 * 1024, append: bool = False, dedup: bool = False,
+                 compression: XP3CompressionPolicy = None, segment_size: int = 0):
         """
         :param buffer: Buffer object to write data to
         :param silent: Supress prints
         :param use_numpy: Use Numpy for XORing if available
+        :param jobs: Number of workers to compress and encrypt files with
+        :param max_in_flight: Maximum amount of bytes waiting for the workers before the writer blocks
+        :param append: Update the archive already in the buffer, existing data is kept in place,
+                       new files are written after the last segment and adding an existing file replaces it
+        :param dedup: Store identical files only once, entries with the same data and encryption share segments
+        :param compression: Compression policy to use, by default everything is compressed at level 9
+        :param segment_size: Split files bigger than this into segments compressed independently (and in parallel
+                             with several jobs), so they can be decompressed in parallel and partially, 0 to not split
         """
         if not buffer:
             buffer = BytesIO()
         self.buffer = buffer
         self.file_entries = []
+        self.append = append
         self.silent = silent
         self.use_numpy = use_numpy
-        buffer.seek(0)
-        buffer.write(XP3Signature)
-        buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
+        self.jobs = jobs
+        self.max_in_flight = max_in_flight
+        self._executor = None
+        self._in_flight = deque()
+        self._in_flight_bytes = 0
+        self._in_flight_jobs = 0  # Files in flight that the workers compress, raw copies queued between them aside
         self.packed_up = False
-        self._filenames = []
+        self._filenames = set()
+        self._replaced = set()
+        self.compression = compression or XP3CompressionPolicy()
+        self.segment_size = segment_size
+        self.dedup = dedup
+        self.dedup_files = 0  # Files that reused the data of another file
+        self.dedup_saved = 0  # Bytes not written thanks to that
+        self._contents = {}  # (digest, encryption type) -> (Adler-32, segments), None while in flight
+        self._gaps = []  # Unused [offset, size] ranges between the data of an archive being updated
+        if append:
+            self._read_existing()
+        else:
+            buffer.seek(0)
+            buffer.write(XP3Signature)
+            buffer.write(struct.pack('<Q', 0))  # File index offset placeholder
+
+    def _read_existing(self):
+        """
+        Load the file index of the archive in the buffer and move past everything it still uses,
+        new data only goes where it can't break the archive if the update is cut short
+        """
+        self.buffer.seek(0)
+        if XP3Signature != self.buffer.read(len(XP3Signature)):
+            raise AssertionError('Is not an XP3 file')
+        self.file_entries = list(XP3FileIndex.read_from(self.buffer))
+        self._filenames = {entry.file_path for entry in self.file_entries}
+
+        used = [(0, len(XP3Signature) + 8)] + XP3FileIndex.regions(self.buffer)
+        used += [(segment.offset, segment.offset + segment.compressed_size)
+                 for entry in self.file_entries for segment in entry.segm]
+        end = 0
+        for start, stop in sorted(used):
+            if start > end:  # Nothing uses it anymore, like the file index of an earlier update
+                self._gaps.append([end, start - end])
+            end = max(end, stop)
+        # Anything past the live file index is left over from an update that was cut short
+        self.buffer.seek(end)
 
     def __enter__(self):
         return self
@@ -33,32 +160,188 @@ class XP3Writer:
             self.pack_up()
         self.buffer.close()
 
-    def add(self, internal_filepath: str, file: bytes, encryption_type: str = None, timestamp: int = 0):
+    def add(self, internal_filepath: str, file, encryption_type: str = None, timestamp: int = 0,
+            compression: XP3CompressionPolicy = None):
         """
         Add a file to the archive
         :param internal_filepath: Internal file path
-        :param file: File to add
+        :param file: File to add, either bytes, a file object or an iterable of byte chunks,
+                     the latter two are streamed into the archive chunk by chunk
         :param encryption_type: Encryption type to encrypt with
         :param timestamp: Timestamp (in milliseconds) to save
+        :param compression: Compression policy to use instead of the writer's one
         """
-        if self.packed_up:
-            raise Exception('Archive is already packed up')
-        if internal_filepath in self._filenames:
-            raise FileExistsError
+        self._register_filename(internal_filepath)
+        compression = compression or self.compression
+        if not isinstance(file, (bytes, bytearray, memoryview)):
+            self._flush_in_flight()
+            self._add_stream(internal_filepath, file, encryption_type, timestamp, compression)
+            return
+
+        content = self._content_key(hashlib.blake2b(file).digest(), encryption_type) if self.dedup else None
+        if content and self._add_duplicate(internal_filepath, content, encryption_type, timestamp):
+            return
+        if self.segment_size and len(file) > self.segment_size:
+            self._flush_in_flight()
+            view = memoryview(file)
+            pieces = (view[start:start + self.segment_size] for start in range(0, len(view), self.segment_size))
+            self._add_segmented(internal_filepath, pieces, zlib.adler32(file), encryption_type, timestamp,
+                                compression, content)
+            return
+        if self.jobs > 1:
+            self._submit(internal_filepath, file, encryption_type, timestamp, content, compression)
+            return
 
-        self._filenames.append(internal_filepath)
         file_entry, file = self._create_file_entry(
             internal_filepath=internal_filepath,
             uncompressed_data=file,
             offset=self.buffer.tell(),
             encryption_type=encryption_type,
-            timestamp=timestamp)
+            timestamp=timestamp,
+            compression=compression)
+        self._write_file_entry(file_entry, file, content)
+
+    def _content_key(self, digest: bytes, encryption_type: str) -> tuple:
+        """Identify file data, files with the same data are only the same when encrypted the same way too"""
+        return digest, None if encryption_type in ('none', None) else encryption_type
+
+    def _add_duplicate(self, internal_filepath, content: tuple, encryption_type: str = None,
+                       timestamp: int = 0) -> bool:
+        """Add an entry pointing to the data of an already added identical file, returns False if there is none"""
+        if content in self._contents and self._contents[content] is None:  # Original is still being compressed
+            self._flush_in_flight()
+        if self._contents.get(content) is None:
+            # Nothing added yet, or writing the original failed and left its placeholder, this file becomes the original
+            self._contents[content] = None
+            return False
+
+        adler32, segments = self._contents[content]
+        file_entry = self._file_entry(internal_filepath, adler32, list(segments), encryption_type, timestamp)
+        self.dedup_files += 1
+        self.dedup_saved += file_entry.segm.compressed_size
+        self._write_file_entry(file_entry, b'')
+        return True
+
+    def add_raw_entry(self, file: XP3File, timestamp: int = None):
+        """
+        Copy a file from another archive as it's stored there, without decompressing, decrypting or recompressing it,
+        only the segment offsets are rewritten. With several jobs the copy can wait for the files added before it,
+        its archive has to stay open until the writer is flushed or packed up
+        :param file: File of an archive open for reading
+        :param timestamp: Timestamp (in milliseconds) to save instead of the original one
+        """
+        self._register_filename(file.file_path)
+        encryption = XP3FileEncryption(file.encryption.adler32, file.encryption.file_path, file.encryption.name) \
+            if file.encryption else None
+        time = XP3FileTime.from_milliseconds(file.time.milliseconds) if timestamp is None else XP3FileTime(timestamp)
+        info = XP3FileInfo(file.info.is_encrypted, file.info.uncompressed_size, file.info.compressed_size,
+                           file.info.file_path)
+        file_entry = XP3FileEntry(encryption=encryption, time=time, adlr=XP3FileAdler(file.adler32),
+                                  segm=XP3FileSegments(list(file.segm)), info=info)
+        if self._in_flight:
+            # Queued behind the files still being compressed, copied when its turn comes to keep the order
+            future = Future()
+            future.set_result((file_entry, file))
+            self._in_flight.append((future, None, None))  # No size, the workers aren't involved
+        else:
+            self._write_raw_entry(file_entry, file)
+
+    def _write_raw_entry(self, file_entry: XP3FileEntry, file: XP3File):
+        """Copy the segments of a file from its archive to the current position"""
+        segments = []
+        for segment in file.segm:
+            segments.append(segment._replace(offset=self.buffer.tell()))
+            self._copy_range(file, segment.offset, segment.compressed_size)
+        file_entry.segm.segments = segments
+        self._write_file_entry(file_entry, b'')
+
+    def _copy_range(self, file: XP3File, offset: int, size: int):
+        """Copy bytes of the file's archive into the buffer, in kernel with os.copy_file_range if possible"""
+        position = self.buffer.tell()
+        if hasattr(os, 'copy_file_range'):
+            try:
+                source, destination = file.buffer.fileno(), self.buffer.fileno()
+                self.buffer.flush()
+                copied = 0
+                while copied < size:
+                    count = os.copy_file_range(source, destination, size - copied, offset + copied, position + copied)
+                    if not count:
+                        raise AssertionError('Unexpected end of archive')
+                    copied += count
+                self.buffer.seek(position + size)
+                return
+            except (AttributeError, io.UnsupportedOperation):  # Not an actual file, e.g. BytesIO
+                pass
+            except OSError:  # Not supported between these files, copy it the usual way
+                self.buffer.seek(position)
+
+        for start in range(offset, offset + size, self.stream_chunk_size):
+            self.buffer.write(file.source.read(start, min(self.stream_chunk_size, offset + size - start)))
+
+    def _register_filename(self, internal_filepath: str):
+        if self.packed_up:
+            raise Exception('Archive is already packed up')
+        if internal_filepath in self._filenames:
+            if not self.append:
+                raise FileExistsError
+            self._replaced.add(internal_filepath)
+        self._filenames.add(internal_filepath)
+
+    def _write_file_entry(self, file_entry: XP3FileEntry, data: bytes, content: tuple = None):
+        if file_entry.file_path in self._replaced:
+            # Replaced file's data is left in place, it's just not referenced by the index anymore
+            self.file_entries = [entry for entry in self.file_entries if entry.file_path != file_entry.file_path]
         self.file_entries.append(file_entry)
         if not self.silent:
-            print('| Packing {} ({} -> {} bytes)'.format(internal_filepath,
+            print('| Packing {} ({} -> {} bytes)'.format(file_entry.file_path,
                                                          file_entry.segm.uncompressed_size,
                                                          file_entry.segm.compressed_size))
-        self.buffer.write(file)
+        gap = next((gap for gap in self._gaps if gap[1] >= len(data)), None) if data else None
+        if gap:
+            # Reuse space left unused by earlier updates, the data was laid out for the current position
+            shift = gap[0] - self.buffer.tell()
+            file_entry.segm.segments = [segment._replace(offset=segment.offset + shift) for segment in file_entry.segm]
+            end = self.buffer.tell()
+            self.buffer.seek(gap[0])
+            self.buffer.write(data)
+            self.buffer.seek(end)
+            gap[0] += len(data)
+            gap[1] -= len(data)
+        else:
+            self.buffer.write(data)
+        if content:
+            self._contents[content] = file_entry.adler32, file_entry.segm.segments
+
+    def _submit(self, internal_filepath, file, encryption_type, timestamp, content: tuple = None,
+                compression: XP3CompressionPolicy = None):
+        """Hand the file over to the workers, writing out the finished ones if too much is in flight"""
+        if not self._executor:
+            self._executor = ThreadPoolExecutor(self.jobs)
+        future = self._executor.submit(self._create_file_entry, internal_filepath, file, 0, encryption_type, timestamp,
+                                       compression)
+        self._in_flight.append((future, len(file), content))
+        self._in_flight_bytes += len(file)
+        self._in_flight_jobs += 1
+
+        while self._in_flight_jobs > self.jobs * 2 or self._in_flight_bytes > self.max_in_flight:
+            self._write_next()
+
+    def _write_next(self):
+        """Wait for the oldest submitted file and write it, offsets are assigned here to keep the order deterministic"""
+        future, size, content = self._in_flight.popleft()
+        if size is None:  # Raw copy
+            self._write_raw_entry(*future.result())
+            return
+        self._in_flight_bytes -= size
+        self._in_flight_jobs -= 1
+        file_entry, data = future.result()
+        file_entry.segm.segments = [segment._replace(offset=self.buffer.tell()) for segment in file_entry.segm]
+        self._write_file_entry(file_entry, data, content)
+
+    def _flush_in_flight(self):
+        """Write out everything in flight, the workers are kept for the files that come next"""
+        while self._in_flight:
+            self._write_next()
 
     def pack_up(self) -> bytes:
         """
@@ -69,10 +352,29 @@ class XP3Writer:
             if hasattr(self.buffer, 'getvalue'):
                 return self.buffer.getvalue()
 
+        try:
+            self._flush_in_flight()
+        finally:
+            if self._executor:
+                self._executor.shutdown()
+                self._executor = None
+        if self.dedup and not self.silent:
+            print('Deduplicated {} file(s), saved {} bytes'.format(self.dedup_files, self.dedup_saved))
+        if self.compression.stats and not self.silent:
+            print(self.compression.report())
+
         # Write the file index
         file_index = XP3FileIndex.from_entries(self.file_entries).to_bytes()
         file_index_offset = self.buffer.tell()
         self.buffer.write(file_index)
+        if self.append:
+            self.buffer.truncate()  # Cut off what's left of an update that was cut short
+            # The new file index has to be on disk before the header points to it
+            self.buffer.flush()
+            try:
+                os.fsync(self.buffer.fileno())
+            except (AttributeError, io.UnsupportedOperation, OSError):  # Not an actual file
+                pass
 
         # Go back to the header and write the offset
         self.buffer.seek(len(XP3Signature))
@@ -86,7 +388,7 @@ class XP3Writer:
             return self.buffer.getvalue()
 
     def _create_file_entry(self, internal_filepath, uncompressed_data, offset, encryption_type: str = None,
-                           timestamp: int = 0) -> (XP3FileEntry, bytes):
+                           timestamp: int = 0, compression: XP3CompressionPolicy = None) -> (XP3FileEntry, bytes):
         """
         Create a file entry for a file
         :param internal_filepath: Internal file path
@@ -94,23 +396,17 @@ class XP3Writer:
         :param offset: Position in the buffer to put into the segment data
         :param encryption_type: Encryption type to use
         :param timestamp Timestamp (in milliseconds)
+        :param compression: Compression policy to use instead of the writer's one
         :return XP3FileEntry object and compressed or uncompressed file (to write into buffer)
         """
 
         adlr = XP3FileAdler.from_data(uncompressed_data)
-
-        is_encrypted = False if encryption_type in ('none', None) else True
-        if is_encrypted:
+        if encryption_type not in ('none', None):
             uncompressed_data = self.xor(uncompressed_data, adlr.value, encryption_type, self.use_numpy)
-            _, _, _, name = encryption_parameters[encryption_type]
-            encryption = XP3FileEncryption(adlr.value, internal_filepath, name)
-            path_hash = hashlib.md5(internal_filepath.lower().encode('utf-16le')).hexdigest()
-        else:
-            encryption = path_hash = None
 
         uncompressed_size = len(uncompressed_data)
-        compressed_data = zlib.compress(uncompressed_data, level=9)
-        compressed_size = len(compressed_data)
+        compressed_data = (compression or self.compression).compress(internal_filepath, uncompressed_data)
+        compressed_size = len(compressed_data) if compressed_data is not None else uncompressed_size
 
         if compressed_size >= uncompressed_size:
             data = uncompressed_data
@@ -120,28 +416,216 @@ class XP3Writer:
             data = compressed_data
             is_compressed = True
 
-        time = XP3FileTime(timestamp)
+        segment = XP3FileSegments.segment(
+            is_compressed=is_compressed,
+            offset=offset,
+            uncompressed_size=uncompressed_size,
+            compressed_size=compressed_size
+        )
+        file_entry = self._file_entry(internal_filepath, adlr.value, [segment], encryption_type, timestamp)
+
+        return file_entry, data
+
+    @staticmethod
+    def _file_entry(internal_filepath, adler32: int, segments: list, encryption_type: str = None,
+                    timestamp: int = 0) -> XP3FileEntry:
+        """
+        Create a file entry describing already written segments
+        :param internal_filepath: Internal file path
+        :param adler32: Adler-32 checksum of the unencrypted file
+        :param segments: List of XP3FileSegments.segment
+        :param encryption_type: Encryption type the file was encrypted with
+        :param timestamp Timestamp (in milliseconds)
+        """
+        is_encrypted = False if encryption_type in ('none', None) else True
+        if is_encrypted:
+            _, _, _, name = encryption_parameters[encryption_type]
+            encryption = XP3FileEncryption(adler32, internal_filepath, name)
+            path_hash = hashlib.md5(internal_filepath.lower().encode('utf-16le')).hexdigest()
+        else:
+            encryption = path_hash = None
+
+        segm = XP3FileSegments(segments)
         info = XP3FileInfo(is_encrypted=is_encrypted,
-                           uncompressed_size=uncompressed_size,
-                           compressed_size=compressed_size,
+                           uncompressed_size=segm.uncompressed_size,
+                           compressed_size=segm.compressed_size,
                            file_path=internal_filepath if not is_encrypted else path_hash
                            )
 
+        return XP3FileEntry(encryption=encryption, time=XP3FileTime(timestamp), adlr=XP3FileAdler(adler32),
+                            segm=segm, info=info)
+
+    def _add_stream(self, internal_filepath, file, encryption_type: str = None, timestamp: int = 0,
+                    compression: XP3CompressionPolicy = None):
+        """
+        Add a file from a file object or an iterable of chunks without loading it whole,
+        the checksum is computed in a first pass, then the data is encrypted and compressed into the buffer
+        """
+        source, adler32, uncompressed_size, digest = self._open_source(file)
+        content = self._content_key(digest, encryption_type) if self.dedup else None
+        if content and self._add_duplicate(internal_filepath, content, encryption_type, timestamp):
+            if source is not file:
+                source.close()
+            return
+
+        if self.segment_size and uncompressed_size > self.segment_size:
+            try:
+                pieces = iter(lambda: source.read(self.segment_size), b'')
+                self._add_segmented(internal_filepath, pieces, adler32, encryption_type, timestamp, compression,
+                                    content)
+            finally:
+                if source is not file:
+                    source.close()
+            return
+
+        try:
+            start = source.tell()
+            offset = self.buffer.tell()
+            is_encrypted = encryption_type not in ('none', None)
+
+            def chunks():
+                source.seek(start)
+                position = 0
+                while True:
+                    chunk = source.read(self.stream_chunk_size)
+                    if not chunk:
+                        break
+                    if is_encrypted:
+                        chunk = self.xor(chunk, adler32, encryption_type, self.use_numpy, position)
+                    position += len(chunk)
+                    yield chunk
+
+            compression = compression or self.compression
+            started = time.perf_counter()
+            source.seek(start)
+            name, level = compression.choose(internal_filepath, source.read(compression.probe_size))
+            compressed_size = uncompressed_size
+            if level:
+                compressor = zlib.compressobj(level=level)
+                compressed_size = 0
+                for chunk in chunks():
+                    compressed_size += self.buffer.write(compressor.compress(chunk))
+                    if compressed_size >= uncompressed_size:
+                        break  # Not going to shrink anymore
+                else:
+                    compressed_size += self.buffer.write(compressor.flush())
+            compression.record(name, time.perf_counter() - started, uncompressed_size, compressed_size)
+
+            is_compressed = compressed_size < uncompressed_size
+            if not is_compressed:
+                # Compression didn't pay off, store the data as is
+                self.buffer.seek(offset)
+                self.buffer.truncate()
+                for chunk in chunks():
+                    self.buffer.write(chunk)
+                compressed_size = uncompressed_size
+        finally:
+            if source is not file:
+                source.close()
+
         segment = XP3FileSegments.segment(
             is_compressed=is_compressed,
             offset=offset,
             uncompressed_size=uncompressed_size,
             compressed_size=compressed_size
         )
-        segm = XP3FileSegments([segment])
+        file_entry = self._file_entry(internal_filepath, adler32, [segment], encryption_type, timestamp)
+        self._write_file_entry(file_entry, b'', content)
 
-        file_entry = XP3FileEntry(encryption=encryption, time=time, adlr=adlr, segm=segm, info=info)
+    def _add_segmented(self, internal_filepath, pieces, adler32: int, encryption_type: str = None,
+                       timestamp: int = 0, compression: XP3CompressionPolicy = None, content: tuple = None):
+        """
+        Add a file split into segments, each one is encrypted and compressed on its own (by the workers if there
+        are several jobs) and stored uncompressed if compressing it doesn't pay off
+        :param pieces: Iterable of the segment sized pieces of the file
+        :param adler32: Adler-32 checksum of the whole file
+        """
+        compression = compression or self.compression
+        pieces = iter(pieces)
+        first = next(pieces)
+        started = time.perf_counter()
+        name, level = compression.choose(internal_filepath, first)
 
-        return file_entry, data
+        def encoded():
+            pending = deque()
+            position = 0
+            for piece in itertools.chain((first,), pieces):
+                if self.jobs > 1:
+                    if not self._executor:
+                        self._executor = ThreadPoolExecutor(self.jobs)
+                    pending.append(self._executor.submit(self._encode_segment, piece, adler32, encryption_type,
+                                                         position, level))
+                    if len(pending) > self.jobs * 2:
+                        yield pending.popleft().result()
+                else:
+                    yield self._encode_segment(piece, adler32, encryption_type, position, level)
+                position += len(piece)
+            while pending:
+                yield pending.popleft().result()
+
+        segments = []
+        for is_compressed, uncompressed_size, data in encoded():
+            segments.append(XP3FileSegments.segment(is_compressed=is_compressed,
+                                                    offset=self.buffer.tell(),
+                                                    uncompressed_size=uncompressed_size,
+                                                    compressed_size=len(data)))
+            self.buffer.write(data)
+
+        file_entry = self._file_entry(internal_filepath, adler32, segments, encryption_type, timestamp)
+        compression.record(name, time.perf_counter() - started, file_entry.segm.uncompressed_size,
+                           file_entry.segm.compressed_size)
+        self._write_file_entry(file_entry, b'', content)
+
+    def _encode_segment(self, data, adler32: int, encryption_type: str, offset: int, level: int) -> (bool, int, bytes):
+        """
+        Encrypt and compress a piece of a file
+        :param offset: Position of the piece in the file, for the encryption
+        :param level: Compression level, 0 to store
+        :return Whether it's compressed, its uncompressed size and the data to write
+        """
+        if encryption_type not in ('none', None):
+            data = self.xor(data, adler32, encryption_type, self.use_numpy, offset)
+        if level:
+            compressed_data = zlib.compress(data, level=level)
+            if len(compressed_data) < len(data):
+                return True, len(data), compressed_data
+        return False, len(data), bytes(data)
+
+    def _open_source(self, file):
+        """
+        Make a seekable file object out of the input and checksum it,
+        non-seekable files and iterables are spooled into a temporary file on the way
+        :return Seekable file object, Adler-32 checksum, size of the data and its digest (if deduplicating)
+        """
+        adler32 = zlib.adler32(b'')
+        size = 0
+        digest = hashlib.blake2b() if self.dedup else None
+        if hasattr(file, 'read') and file.seekable():
+            source = file
+            start = file.tell()
+            for chunk in iter(lambda: file.read(self.stream_chunk_size), b''):
+                adler32 = zlib.adler32(chunk, adler32)
+                size += len(chunk)
+                if digest:
+                    digest.update(chunk)
+            file.seek(start)
+            return source, adler32, size, digest and digest.digest()
+
+        if hasattr(file, 'read'):
+            file = iter(lambda: file.read(self.stream_chunk_size), b'')
+        source = tempfile.SpooledTemporaryFile(max_size=self.stream_threshold)
+        for chunk in file:
+            adler32 = zlib.adler32(chunk, adler32)
+            size += len(chunk)
+            if digest:
+                digest.update(chunk)
+            source.write(chunk)
+        source.seek(0)
+        return source, adler32, size, digest and digest.digest()
 
     @staticmethod
-    def xor(data, adler32, encryption_type, use_numpy):
-        with BytesIO() as buffer:
-            buffer.write(data)
-            XP3File.xor(buffer, adler32, encryption_type, use_numpy)
-            return buffer.getvalue()
+    def xor(data, adler32, encryption_type, use_numpy, offset: int = 0) -> bytearray:
+        """Return an encrypted copy of the data"""
+        data = bytearray(data)
+        XP3File.xor_inplace(data, adler32, encryption_type, use_numpy, offset)
+        return data